@@ -1,34 +1,380 @@
-from flask import Flask, render_template, request, flash, redirect, url_for, session, g
+from flask import Flask, Request, render_template, request, flash, redirect, url_for, session, g, jsonify, get_template_attribute, send_from_directory, has_app_context
+from markupsafe import Markup, escape
+from werkzeug.exceptions import BadRequest
+import click
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.extras import DictRow
+from PIL import Image, ImageOps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import configparser
+import collections
+import functools
+import hashlib
+import json
+import logging
+import tempfile
+import pickle
+import threading
+import time
+import traceback
 import os
-import uuid
 import re
 
 # Read confir from file
 config = configparser.RawConfigParser()
 config.read('config.txt')
 
-# Initiate Postgres connection
-connection = psycopg2.connect(
-    host = config.get('Database Config', 'DB_HOST'),
-    dbname = config.get('Database Config', 'DB_NAME'),
-    user = config.get('Database Config', 'DB_USER'),
-    password = config.get('Database Config', 'DB_PASS')
-)
+class BoundedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    Thread-safe connection pool that waits (up to a timeout) for a free connection
+    instead of raising right away like ThreadedConnectionPool does when it is exhausted.
+    Also keeps track of how many checkouts there were and how long they had to wait.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+    def getconn(self, key=None):
+        # Wait for a free slot
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self._timeouts += 1
+            raise psycopg2.pool.PoolError('Timed out waiting for a database connection')
+        waited = time.perf_counter() - start
+
+        try:
+            conn = super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self._checkouts += 1
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+    def _putconn(self, conn, key=None, close=False):
+        # The base class keeps only minconn idle connections and closes the others, so every request
+        # beyond the first few would open a new connection. Keep up to maxconn idle instead.
+        # Called with the pool lock held, like the rest of the base class.
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'max_size': self.maxconn,
+                'size': len(self._pool) + len(self._used),
+                'in_use': len(self._used),
+                'idle': len(self._pool),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_seconds_total': self._wait_seconds_total,
+                'wait_seconds_max': self._wait_seconds_max,
+            }
+
+# What is recorded about the SQL run by each request, and when to warn about it
+max_queries_per_request = config.getint('Instrumentation Config', 'MAX_QUERIES', fallback=30)
+repeated_query_threshold = config.getint('Instrumentation Config', 'REPEATED_QUERY_THRESHOLD', fallback=5)
+slow_query_count = config.getint('Instrumentation Config', 'SLOW_QUERY_COUNT', fallback=3)
+log_requests = config.getboolean('Instrumentation Config', 'LOG_REQUESTS', fallback=False)
+
+class QueryStats:
+    """The statements run during one request, with how often they ran and how long they took."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = collections.Counter()
+        self.slowest = []
+
+    def record(self, query, seconds: float) -> None:
+        # The statement is the SQL before the parameters are filled in, so the same query run
+        # in a loop (an N+1 pattern) is counted under one key
+        statement = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+        statement = ' '.join(statement.split())[:200]
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        self.slowest = sorted(self.slowest + [(seconds, statement)], reverse=True)[:slow_query_count]
+
+    def get_repeated_statements(self) -> dict[str, int]:
+        return dict(filter(lambda item: item[1] >= repeated_query_threshold, self.statements.items()))
+
+def get_query_stats() -> QueryStats | None:
+    return g.get('query_stats') if has_app_context() else None
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors (of any cursor factory) record every statement in the QueryStats of the request."""
+
+    instrumented_cursor_factories = {}
+
+    def cursor(self, *args, **kwargs):
+        cursor_factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = get_instrumented_cursor_factory(cursor_factory)
+        return super().cursor(*args, **kwargs)
+
+def get_instrumented_cursor_factory(cursor_factory: type) -> type:
+    instrumented_cursor_factory = InstrumentedConnection.instrumented_cursor_factories.get(cursor_factory)
+    if instrumented_cursor_factory is not None:
+        return instrumented_cursor_factory
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super(instrumented_cursor_factory, self).execute(query, vars)
+        finally:
+            stats = get_query_stats()
+            if stats is not None:
+                stats.record(query, time.perf_counter() - start)
+
+    instrumented_cursor_factory = type(f'Instrumented{cursor_factory.__name__}', (cursor_factory, ), {'execute': execute})
+    InstrumentedConnection.instrumented_cursor_factories[cursor_factory] = instrumented_cursor_factory
+    return instrumented_cursor_factory
+
+# The Postgres connection pool of this process. Importing the module doesn't connect, the pool is opened
+# on first use (or by open_db_pool), so a server that imports the app before forking its workers
+# (see gunicorn.conf.py) doesn't share connections between processes.
+pool = None
+pool_lock = threading.Lock()
+# Pools inherited through fork. They are kept so their connections, which belong to the parent, are never closed here.
+inherited_pools = []
+
+def open_db_pool() -> BoundedConnectionPool:
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = BoundedConnectionPool(
+                config.getint('Database Config', 'DB_POOL_MIN', fallback=1),
+                config.getint('Database Config', 'DB_POOL_MAX', fallback=10),
+                config.getfloat('Database Config', 'DB_POOL_TIMEOUT', fallback=10.0),
+                host = config.get('Database Config', 'DB_HOST'),
+                dbname = config.get('Database Config', 'DB_NAME'),
+                user = config.get('Database Config', 'DB_USER'),
+                password = config.get('Database Config', 'DB_PASS'),
+                connection_factory = InstrumentedConnection
+            )
+        return pool
+
+def close_db_pool() -> None:
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.closeall()
+            pool = None
+
+def forget_inherited_db_pool() -> None:
+    # Runs in the child after a fork, the child opens its own pool when it needs one
+    global pool, pool_lock
+    if pool is not None:
+        inherited_pools.append(pool)
+    pool = None
+    pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=forget_inherited_db_pool)
+
+class LocalCache:
+    """
+    In-process LRU cache where every entry expires after its TTL.
+    Each worker process has its own, so invalidations only reach the process that publishes them.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[bool, object]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value, ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+class RedisCache:
+    """Cache shared by all worker processes, stored in Redis. Has the same interface as LocalCache."""
+
+    def __init__(self, url: str):
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> tuple[bool, object]:
+        data = self._client.get(key)
+        if data is None:
+            return False, None
+        return True, pickle.loads(data)
+
+    def set(self, key: str, value, ttl: int) -> None:
+        self._client.set(key, pickle.dumps(value), ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self._client.delete(key)
+
+# Initiate the read cache
+if config.get('Cache Config', 'BACKEND', fallback='local') == 'redis':
+    if redis is None:
+        raise RuntimeError('The redis cache backend needs the redis package: pip install redis')
+    cache = RedisCache(config.get('Cache Config', 'REDIS_URL'))
+else:
+    cache = LocalCache(config.getint('Cache Config', 'MAX_ENTRIES', fallback=10000))
+
+cache_stats = collections.defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+cache_stats_lock = threading.Lock()
+
+def get_cache_key(namespace: str, *args) -> str:
+    return ':'.join(map(str, ['myfoto', namespace, *args]))
+
+def record_cache_lookup(namespace: str, hit: bool) -> None:
+    with cache_stats_lock:
+        cache_stats[namespace]['hits' if hit else 'misses'] += 1
+
+def cached(namespace: str, ttl: int):
+    # Cache the return value of a lookup by its (positional) arguments, unless it is None
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = get_cache_key(namespace, *args)
+            hit, value = cache.get(key)
+            record_cache_lookup(namespace, hit)
+
+            # Missing rows are not cached: nothing invalidates them when they are created (e.g. add_album)
+            if not hit:
+                value = function(*args)
+                if value is not None:
+                    cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
+
+def invalidate(namespace: str, *args) -> None:
+    # Called by the write helpers after they commit, so the next read gets the new value
+    cache.delete(get_cache_key(namespace, *args))
+    with cache_stats_lock:
+        cache_stats[namespace]['invalidations'] += 1
 
 # Create photos directory in the static directory if it does not exist
 photos_dir = config.get('Photos Config', 'PHOTOS_FOLDER')
 os.makedirs(os.path.join('static', photos_dir), exist_ok=True)
 
+# Smaller renditions generated for every uploaded photo (name -> max width/height in pixels)
+photo_sizes = {
+    'thumb': config.getint('Photos Config', 'THUMB_SIZE', fallback=480),
+    'medium': config.getint('Photos Config', 'MEDIUM_SIZE', fallback=1280),
+}
+photo_quality = config.getint('Photos Config', 'PHOTO_QUALITY', fallback=82)
+
+# Upload limits, checked by the form parser while the upload is written to disk (see PhotoUploadRequest)
+photo_max_bytes = config.getint('Photos Config', 'MAX_PHOTO_BYTES', fallback=20 * 1024 * 1024)
+photo_max_pixels = config.getint('Photos Config', 'MAX_PHOTO_PIXELS', fallback=50_000_000)
+photo_upload_max_files = config.getint('Photos Config', 'MAX_PHOTOS_PER_UPLOAD', fallback=20)
+upload_header_limit = 512 * 1024
+Image.MAX_IMAGE_PIXELS = photo_max_pixels
+
+# How photo files are sent: by the app (none), or by the front proxy through X-Sendfile or X-Accel-Redirect
+photo_sendfile = config.get('Photos Config', 'SENDFILE', fallback='none')
+photo_accel_redirect_prefix = config.get('Photos Config', 'ACCEL_REDIRECT_PREFIX', fallback='/protected-photos')
+
 # Start the app
 app = Flask(__name__)
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/' # In a real situation, should be read from a private config file
+app.use_x_sendfile = photo_sendfile == 'x-sendfile'
+# Requests with a larger body are refused before it is read
+app.config['MAX_CONTENT_LENGTH'] = config.getint('Photos Config', 'MAX_REQUEST_BYTES', fallback=photo_max_bytes * photo_upload_max_files + 1024 * 1024)
 
 guest_user_id = config.get('User Config', 'GUEST_USER_ID')
 
+page_size = config.getint('Pagination Config', 'PAGE_SIZE', fallback=20)
+
+famous_tag_count = 10
+
+# Name searches need a trigram to use users_full_name_trgm_idx, shorter queries would scan the whole index
+name_search_min_length = 3
+
+# Tag searches count a tag's photos up to this many to pick the rarest tag to start from
+tag_count_limit = 10000
+
+# How many likers and comments a photo card shows, the rest are on the photo's likes and comments pages
+card_liker_count = config.getint('Pagination Config', 'CARD_LIKERS', fallback=10)
+card_comment_count = config.getint('Pagination Config', 'CARD_COMMENTS', fallback=5)
+
+photo_card_ttl = config.getint('Cache Config', 'PHOTO_CARD_TTL', fallback=3600)
+
+recommendation_tag_count = config.getint('Recommendations Config', 'TOP_TAGS', fallback=5)
+recommendation_candidate_count = config.getint('Recommendations Config', 'CANDIDATES', fallback=200)
+# How long stale photo recommendations are served before the worker refreshes them
+recommendation_stale_seconds = config.getint('Recommendations Config', 'STALE_SECONDS', fallback=600)
+
+job_lease_seconds = config.getint('Jobs Config', 'LEASE_SECONDS', fallback=300)
+job_retry_seconds = config.getint('Jobs Config', 'RETRY_SECONDS', fallback=10)
+job_max_attempts = config.getint('Jobs Config', 'MAX_ATTEMPTS', fallback=5)
+
+def get_db():
+    # Check out one connection per request (or app context) and keep it in g
+    if 'db' not in g:
+        g.db = (pool or open_db_pool()).getconn()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is None:
+        return
+
+    # Never hand a connection with an open or aborted transaction back to the pool
+    if not db.closed and db.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            db.rollback()
+        except psycopg2.Error:
+            pass
+
+    pool.putconn(db, close=bool(db.closed))
+
 def get_extension(filename: str) -> str | None:
     if '.' not in filename:
         return None
@@ -46,70 +392,388 @@ def is_filename_image(filename: str) -> bool:
 def get_photo_filename_path(filename: str) -> str:
     return f'static/{photos_dir}/{filename}'
 
-def get_photo_url(photo) -> str:
-    return get_photo_filename_url(photo['filename'])
+def get_content_addressed_filename(content_hash: str, extension: str) -> str:
+    # Shard by the first two bytes of the hash, so no directory gets too many files
+    extension = 'jpg' if extension == 'jpeg' else extension
+    return f'{content_hash[0:2]}/{content_hash[2:4]}/{content_hash}.{extension}'
+
+def get_jpeg_dimensions(header: bytes) -> tuple[int, int] | None:
+    # Walk the segments up to the start of frame marker, which holds the dimensions
+    i = 2
+    while i + 4 <= len(header):
+        if header[i] != 0xFF:
+            return None
+        marker = header[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if i + 9 > len(header):
+                return None
+            height = int.from_bytes(header[i + 5:i + 7], 'big')
+            width = int.from_bytes(header[i + 7:i + 9], 'big')
+            return width, height
+        i += 2 + int.from_bytes(header[i + 2:i + 4], 'big')
+    return None
+
+def get_image_info(header: bytes) -> tuple[str, int, int] | None:
+    # Returns the extension and dimensions from the first bytes of a JPEG or PNG file,
+    # or None if the header is not (yet) enough to tell
+    if header.startswith(b'\x89PNG\r\n\x1a\n') and len(header) >= 24 and header[12:16] == b'IHDR':
+        return 'png', int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+    if header.startswith(b'\xff\xd8\xff'):
+        dimensions = get_jpeg_dimensions(header)
+        return None if dimensions is None else ('jpg', *dimensions)
+    return None
+
+def is_image_header_prefix(header: bytes) -> bool:
+    # Reject anything that doesn't start like a JPEG or PNG after the first chunk
+    return any(map(lambda magic: header[:len(magic)] == magic[:len(header)], [b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff']))
+
+class UploadRejected(BadRequest):
+    """Raised while the form is parsed, the message is shown to the user (see upload_rejected)."""
+
+class PhotoUpload:
+    """
+    Where the form parser writes an uploaded file. Each chunk is checked and hashed as it arrives and written
+    straight to a temporary file in the photos directory, which place_photo_file later moves in place.
+    A chunk that breaks a limit raises UploadRejected, so the rest of the request body is never read.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.content_hash = hashlib.sha256()
+        self.header = b''
+        # Extension and dimensions, known once enough of the header has arrived
+        self.image_info = None
+        self.size = 0
+        self.temp_file = tempfile.NamedTemporaryFile(dir=get_photo_filename_path(''), prefix='.upload-', delete=False)
+        self.temp_path = self.temp_file.name
+
+    def reject(self, error: str):
+        raise UploadRejected(f'{self.filename}: {error}')
+
+    def write(self, chunk: bytes) -> int:
+        self.size += len(chunk)
+        if self.size > photo_max_bytes:
+            self.reject(f'Photo is too large, the limit is {photo_max_bytes // (1024 * 1024)} MB')
+
+        if self.image_info is None:
+            self.header += chunk
+            if not is_image_header_prefix(self.header):
+                self.reject('Inappropriate file format')
+            self.image_info = get_image_info(self.header)
+            if self.image_info is None and len(self.header) > upload_header_limit:
+                self.reject('Inappropriate file format')
+            if self.image_info is not None:
+                self.header = b''
+                width, height = self.image_info[1:]
+                if width == 0 or height == 0 or width * height > photo_max_pixels:
+                    self.reject(f'Photo dimensions {width}x{height} are not allowed')
+
+        self.content_hash.update(chunk)
+        return self.temp_file.write(chunk)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.temp_file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.temp_file.read(size)
+
+    def close(self) -> None:
+        self.temp_file.close()
+
+class PhotoUploadRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.photo_uploads = []
+
+    # Credits: https://werkzeug.palletsprojects.com/en/3.0.x/wrappers/#werkzeug.wrappers.Request._get_file_stream
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Called by the form parser for every file in the body, before any of its bytes are read
+        if len(self.photo_uploads) >= photo_upload_max_files:
+            raise UploadRejected(f'Please upload at most {photo_upload_max_files} photos at once')
+        # An empty filename is an empty file input, it has no content to check
+        if filename and not is_filename_image(filename):
+            raise UploadRejected(f'{filename}: Inappropriate file format')
+
+        upload = PhotoUpload(filename or '')
+        self.photo_uploads.append(upload)
+        return upload
+
+app.request_class = PhotoUploadRequest
+
+@app.teardown_request
+def remove_photo_uploads(error):
+    # Uploads that were not moved in place (rejected, or the request failed) are deleted
+    for upload in request.photo_uploads:
+        upload.close()
+        if os.path.exists(upload.temp_path):
+            os.remove(upload.temp_path)
+
+def place_photo_file(temp_path: str, filename: str) -> None:
+    # Move the upload to its content addressed path. If the same content is already stored,
+    # the rename just replaces it with identical bytes.
+    path = get_photo_filename_path(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+
+def get_photo_derivative_filename(filename: str, size: str) -> str:
+    # e.g. abc.jpg -> abc.thumb.jpg
+    stem, extension = filename.rsplit('.', 1)
+    return f'{stem}.{size}.{extension}'
+
+def get_photo_rendition_filename(photo, size: str | None = None) -> str:
+    filename = photo['filename']
+
+    # Fall back to the original if the rendition was not generated (yet)
+    if size is not None:
+        derivative_filename = get_photo_derivative_filename(filename, size)
+        if os.path.exists(get_photo_filename_path(derivative_filename)):
+            filename = derivative_filename
+
+    return filename
+
+def get_photo_url(photo, size: str | None = None) -> str:
+    return get_photo_filename_url(get_photo_rendition_filename(photo, size))
 
 def get_photo_filename_url(filename: str) -> str:
-    filename_in_photos_dir = f'{photos_dir}/{filename}'
-    return url_for('static', filename=filename_in_photos_dir)
+    return url_for('serve_photo', filename=filename)
+
+def create_photo_derivatives(filename: str) -> None:
+    with Image.open(get_photo_filename_path(filename)) as original:
+        # Metadata is not copied to the renditions, so apply the EXIF orientation first
+        image = ImageOps.exif_transpose(original)
+        is_jpeg = get_extension(filename) in ['jpg', 'jpeg']
+        if is_jpeg and image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        for size, max_dimension in photo_sizes.items():
+            derivative = image.copy()
+            derivative.thumbnail((max_dimension, max_dimension))
+            derivative_path = get_photo_filename_path(get_photo_derivative_filename(filename, size))
+            if is_jpeg:
+                derivative.save(derivative_path, format='JPEG', quality=photo_quality, optimize=True, progressive=True)
+            else:
+                derivative.save(derivative_path, format='PNG', optimize=True)
+
+def remove_photo_files(filename: str) -> None:
+    # Remove the original and all of its renditions
+    filenames = [filename] + list(map(lambda size: get_photo_derivative_filename(filename, size), photo_sizes))
+    for filename in filenames:
+        full_filename = get_photo_filename_path(filename)
+        try:
+            os.remove(full_filename)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(f'Error: Could not remove photo file: {full_filename}')
+
+def parse_cursor(cursor: str) -> tuple[int, ...] | None:
+    # A cursor is the sort key of a row, e.g. '42' or '3-42' for composite keys
+    parts = cursor.split('-')
+    if not all(map(lambda part: part.isdigit(), parts)):
+        return None
+    return tuple(map(int, parts))
+
+def format_cursor(key: tuple[int, ...]) -> str:
+    return '-'.join(map(str, key))
+
+def get_page_cursors() -> tuple[tuple[int, ...] | None, tuple[int, ...] | None]:
+    # Read the keyset pagination cursors from the query string
+    after = parse_cursor(request.args.get('after', ''))
+    before = parse_cursor(request.args.get('before', ''))
+    return after, before
+
+def keyset_condition(columns: list[str], after: tuple | None, before: tuple | None) -> tuple[str, str, tuple, tuple | None, tuple | None]:
+    """
+    Build the condition, order and parameters for keyset pagination on the given columns.
+    Pages before a cursor are fetched in descending order and flipped back by make_page.
+    Also returns the after and before cursors that were actually used (a cursor for other columns is ignored),
+    which are the ones to pass to make_page.
+    """
+    row = f'({", ".join(columns)})'
+    placeholders = f'({", ".join(["%s"] * len(columns))})'
+
+    if before is not None and len(before) == len(columns):
+        return f'{row} < {placeholders}', ', '.join(map(lambda c: f'{c} desc', columns)), before, None, before
+    if after is not None and len(after) == len(columns):
+        return f'{row} > {placeholders}', ', '.join(map(lambda c: f'{c} asc', columns)), after, after, None
+    return 'true', ', '.join(map(lambda c: f'{c} asc', columns)), (), None, None
+
+def make_page(rows: list, key, after: tuple | None, before: tuple | None, limit: int) -> tuple[list, str | None, str | None]:
+    # Queries fetch one row more than the limit to know whether there is another page
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    prev_cursor = None
+    next_cursor = None
+
+    if before is not None:
+        rows.reverse()
+        if has_more and len(rows) > 0:
+            prev_cursor = format_cursor(key(rows[0]))
+        if len(rows) > 0:
+            next_cursor = format_cursor(key(rows[-1]))
+    else:
+        if after is not None and len(rows) > 0:
+            prev_cursor = format_cursor(key(rows[0]))
+        if has_more:
+            next_cursor = format_cursor(key(rows[-1]))
+
+    return rows, prev_cursor, next_cursor
+
+def get_page_url_args(args: dict, cursor: dict) -> dict:
+    # Keep the rest of the query string (e.g. searched tags) and replace the cursor
+    args = dict(filter(lambda arg: arg[0] not in ('after', 'before'), args.items()))
+    return {**args, **cursor}
+
+def get_page_url(**cursor) -> str:
+    return url_for(request.endpoint, **request.view_args, **get_page_url_args(request.args.to_dict(), cursor))
 
 def get_user_by_login(email: str, password: str) -> DictRow | None:
     # Credits: https://www.psycopg.org/docs/extras.html
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
     dict_cursor.execute('select u.user_id, u.first_name, u.last_name from users u where u.email = %s and u.password = %s', (email, password))
     user = dict_cursor.fetchone()
     dict_cursor.close()
     return user
 
+# The queries shared with asgi.py are kept in module level strings, so both apps read (and cache) the same rows
+user_by_user_id_query = 'select u.user_id, u.first_name, u.last_name from users u where u.user_id = %s'
+
+@cached('user', ttl=300)
 def get_user_by_user_id(user_id: int) -> DictRow | None:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute('select u.user_id, u.first_name, u.last_name from users u where u.user_id = %s', (user_id, ))
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(user_by_user_id_query, (user_id, ))
     user = dict_cursor.fetchone()
     dict_cursor.close()
     return user
 
+top_users_query = """
+    select u.user_id, u.first_name, u.last_name, s.score
+    from user_scores s
+    join users u on u.user_id = s.user_id
+    where s.user_id != %s
+    order by s.score desc
+    limit %s
+"""
+
 def get_top_users(user_count: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select u.user_id, u.first_name, u.last_name, (user_comments_count.comment_count + user_photo_count.photo_count) as score
-        from (
-            select u.user_id, coalesce(count(comment_id), 0) as comment_count
-            from users u
-            left join comments c on c.user_id = u.user_id
-            group by u.user_id
-        ) user_comments_count
-        join
-        (
-            select u.user_id, coalesce(count(photo_id), 0) as photo_count
-            from users u
-            left join albums a on a.owner_id = u.user_id
-            left join photos p on p.album_id = a.album_id
-            group by u.user_id
-        ) user_photo_count on user_comments_count.user_id = user_photo_count.user_id
-        join users u on u.user_id = user_comments_count.user_id
-        where u.user_id != %s
-        order by score desc
-        limit %s
-    """, (guest_user_id, user_count, ))
+    # Scores are kept up to date by the write helpers, see update_user_score
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(top_users_query, (int(guest_user_id), user_count, ))
     users = dict_cursor.fetchall()
     dict_cursor.close()
     return users
 
+def update_user_score(cursor, user_id: int, comment_delta: int, photo_delta: int) -> None:
+    # Must run in the same transaction as the write that changed the counts
+    cursor.execute("""
+        insert into user_scores (user_id, comment_count, photo_count)
+        values (%s, %s, %s)
+        on conflict (user_id) do update
+        set comment_count = user_scores.comment_count + excluded.comment_count,
+            photo_count = user_scores.photo_count + excluded.photo_count
+    """, (user_id, comment_delta, photo_delta))
+
+def subtract_deleted_photos_from_scores(cursor, photo_condition: str, params: tuple) -> None:
+    # Must run before the photos are deleted. Deleting photos also cascades to their comments,
+    # so both the owner's photo count and the commenters' comment counts go down.
+    cursor.execute(f"""
+        update user_scores s
+        set photo_count = s.photo_count - d.photo_count
+        from (
+            select a.owner_id, count(*) as photo_count
+            from photos p
+            join albums a on a.album_id = p.album_id
+            where {photo_condition}
+            group by a.owner_id
+        ) d
+        where s.user_id = d.owner_id
+    """, params)
+    cursor.execute(f"""
+        update user_scores s
+        set comment_count = s.comment_count - d.comment_count
+        from (
+            select c.user_id, count(*) as comment_count
+            from comments c
+            join photos p on p.photo_id = c.photo_id
+            where {photo_condition}
+            group by c.user_id
+        ) d
+        where s.user_id = d.user_id
+    """, params)
+
+# Scores computed from scratch, used to rebuild and verify user_scores
+expected_user_scores_query = """
+    select u.user_id, coalesce(c.comment_count, 0) as comment_count, coalesce(p.photo_count, 0) as photo_count
+    from users u
+    left join (
+        select c.user_id, count(*) as comment_count
+        from comments c
+        group by c.user_id
+    ) c on c.user_id = u.user_id
+    left join (
+        select a.owner_id, count(*) as photo_count
+        from albums a
+        join photos p on p.album_id = a.album_id
+        group by a.owner_id
+    ) p on p.owner_id = u.user_id
+"""
+
+def get_user_score_drift() -> list[DictRow]:
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(f"""
+        select e.user_id,
+            e.comment_count as expected_comment_count, s.comment_count,
+            e.photo_count as expected_photo_count, s.photo_count
+        from ({expected_user_scores_query}) e
+        left join user_scores s on s.user_id = e.user_id
+        where s.user_id is null
+            or s.comment_count != e.comment_count
+            or s.photo_count != e.photo_count
+        order by e.user_id
+    """)
+    drift = dict_cursor.fetchall()
+    dict_cursor.close()
+    return drift
+
+def rebuild_user_scores() -> None:
+    cursor = get_db().cursor()
+    cursor.execute(f"""
+        insert into user_scores (user_id, comment_count, photo_count)
+        {expected_user_scores_query}
+        on conflict (user_id) do update
+        set comment_count = excluded.comment_count,
+            photo_count = excluded.photo_count
+    """)
+    get_db().commit()
+    cursor.close()
+
 def add_user(first_name, last_name, hometown, gender, email, birth_date, password) -> bool:
     error = None
-    cursor = connection.cursor()
+    cursor = get_db().cursor()
     
     try:
         if len(birth_date) > 0:
             cursor.execute("""
                 insert into users (first_name, last_name, hometown, gender, email, birth_date, password)
                 values (%s, %s, %s, %s, %s, %s, %s)
+                returning user_id
             """, (first_name, last_name, hometown, gender, email, birth_date, password))
         else:
             cursor.execute("""
                 insert into users (first_name, last_name, hometown, gender, email, password)
                 values (%s, %s, %s, %s, %s, %s)
-            """, (first_name, last_name, hometown, gender, email, password))    
+                returning user_id
+            """, (first_name, last_name, hometown, gender, email, password))
+        # Start the user with a score of 0
+        update_user_score(cursor, cursor.fetchone()[0], 0, 0)
     except psycopg2.errors.UniqueViolation:
         error = 'That email is already in use. Please try again.'
     except psycopg2.errors.CheckViolation:
@@ -117,7 +781,7 @@ def add_user(first_name, last_name, hometown, gender, email, birth_date, passwor
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
+    get_db().commit()
     cursor.close()
     
     if error is not None:
@@ -127,7 +791,7 @@ def add_user(first_name, last_name, hometown, gender, email, birth_date, passwor
     return True
 
 def add_album(album_name: str, owner_id: int) -> bool:
-    cursor = connection.cursor()
+    cursor = get_db().cursor()
     error = None
 
     try:
@@ -138,7 +802,7 @@ def add_album(album_name: str, owner_id: int) -> bool:
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
+    get_db().commit()
     cursor.close()
 
     if error is not None:
@@ -147,120 +811,260 @@ def add_album(album_name: str, owner_id: int) -> bool:
 
     return True
 
+album_by_album_id_query = 'select * from albums a where a.album_id = %s'
+
+# All albums, or the ones of an owner (owner_condition), with the owner's name. Formatted with keyset_condition.
+albums_query = """
+    select a.*, u.first_name as owner_first_name, u.last_name as owner_last_name
+    from albums a
+    join users u on u.user_id = a.owner_id
+    where {owner_condition} and {condition}
+    order by {order}
+    limit %s
+"""
+
+@cached('album', ttl=300)
 def get_album_by_album_id(album_id: int) -> DictRow | None:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute('select * from albums a where a.album_id = %s', (album_id, ))
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(album_by_album_id_query, (album_id, ))
     album = dict_cursor.fetchone()
     dict_cursor.close()
     return album
 
-def get_albums_by_owner_id(owner_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select *, u.first_name as owner_first_name, u.last_name as owner_last_name
-        from albums a
-        join users u on u.user_id = a.owner_id
-        where a.owner_id = %s
-    """, (owner_id, ))
+def get_albums_by_owner_id(owner_id: int, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['a.album_id'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(albums_query.format(owner_condition='a.owner_id = %s', condition=condition, order=order), (owner_id, *cursor_params, limit + 1))
     albums = dict_cursor.fetchall()
     dict_cursor.close()
-    return albums
+    return make_page(albums, lambda album: (album['album_id'], ), after, before, limit)
 
-def get_all_albums() -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select *, u.first_name as owner_first_name, u.last_name as owner_last_name
-        from albums a
-        join users u on u.user_id = a.owner_id
-    """)
+def get_all_albums(after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['a.album_id'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(albums_query.format(owner_condition='true', condition=condition, order=order), (*cursor_params, limit + 1))
     albums = dict_cursor.fetchall()
     dict_cursor.close()
-    return albums
+    return make_page(albums, lambda album: (album['album_id'], ), after, before, limit)
 
-def get_photo_album_owner_id(photo_id: int) -> int:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select a.owner_id as owner_id
+def get_photos_album_owner_ids(photo_ids: list[int]) -> dict[int, int]:
+    cursor = get_db().cursor()
+    cursor.execute("""
+        select p.photo_id, a.owner_id
         from albums a
         join photos p on p.album_id = a.album_id
-        where p.photo_id = %s
-    """, (photo_id, ))
-    album = dict_cursor.fetchone()
-    dict_cursor.close()
-    return album['owner_id']
+        where p.photo_id = any (%s)
+    """, (photo_ids, ))
+    tuples = cursor.fetchall()
+    cursor.close()
+    return dict(tuples)
 
-def add_photo(caption, filename, album_id) -> int | None:
-    cursor = connection.cursor()
+def add_photos(album_id: int, photos: list[tuple[str, str]], tag_labels: list[str]) -> list[int] | None:
+    # Add (caption, filename) photos with the same tags in one transaction,
+    # with a fixed number of statements no matter how many photos there are
+    cursor = get_db().cursor()
     error = None
 
-    # Add the photo
-    # Get the photo id
-    # Partial credits: https://stackoverflow.com/a/2944481/4580269
     try:
+        # Reserve the ids up front so the tag links can be built without reading the photos back
+        cursor.execute("""
+            select nextval(pg_get_serial_sequence('photos', 'photo_id'))
+            from generate_series(1, %s)
+        """, (len(photos), ))
+        photo_ids = list(map(lambda tuple: tuple[0], cursor.fetchall()))
+        psycopg2.extras.execute_values(cursor, """
+            insert into photos (photo_id, caption, filename, album_id)
+            values %s
+        """, list(map(lambda photo_id, photo: (photo_id, photo[0], photo[1], album_id), photo_ids, photos)), page_size=len(photos))
+        # Create the missing tags and link all of them to all the photos
+        cursor.execute("""
+            insert into tags (label)
+            select unnest(%s::varchar[])
+            on conflict do nothing
+        """, (tag_labels, ))
         cursor.execute("""
-            insert into photos (caption, filename, album_id)
-            values (%s, %s, %s)
-            returning photo_id
-        """, (caption, filename, album_id))
+            insert into photo_tags (photo_id, tag_label)
+            select p.photo_id, t.tag_label
+            from unnest(%s::int[]) p (photo_id)
+            cross join unnest(%s::varchar[]) t (tag_label)
+            on conflict do nothing
+        """, (photo_ids, tag_labels))
+        invalidate_photo_recommendations(cursor, 'p.photo_id = any (%s)', (photo_ids, ))
+        # Update the album owner's score
+        cursor.execute('select owner_id from albums where album_id = %s', (album_id, ))
+        update_user_score(cursor, cursor.fetchone()[0], 0, len(photos))
+        # Leave the image processing to the worker, it is only needed the first time a file is stored
+        new_filenames = reference_photo_files(cursor, list(map(lambda photo: photo[1], photos)))
+        psycopg2.extras.execute_values(cursor, """
+            insert into jobs (kind, payload)
+            values %s
+        """, list(map(lambda filename: ('create_photo_derivatives', psycopg2.extras.Json({'filename': filename})), new_filenames)))
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
-    
+    get_db().commit()
+    cursor.close()
+
     if error is not None:
-        cursor.close()
         flash(error)
         return None
-    
-    photo_id = cursor.fetchone()
-    cursor.close()
-    return photo_id
 
-def get_photos_by_album_id(album_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute('select * from photos p where p.album_id = %s', (album_id, ))
+    if len(tag_labels) > 0:
+        invalidate('famous_tags', famous_tag_count)
+    return photo_ids
+
+def lock_photo_file(cursor, filename: str) -> None:
+    # Held until the end of the transaction, so a file can't be garbage collected while it gets a new reference
+    cursor.execute('select pg_advisory_xact_lock(hashtext(%s))', (filename, ))
+
+def reference_photo_files(cursor, filenames: list[str]) -> list[str]:
+    # Add one reference per occurrence in the list. Returns the files that were not stored before.
+    # The locks are taken in a fixed order, so two batches can't deadlock.
+    cursor.execute("""
+        select pg_advisory_xact_lock(hashtext(f.filename))
+        from (select distinct unnest(%s::varchar[]) as filename order by 1) f
+    """, (filenames, ))
+    counts = collections.Counter(filenames)
+    cursor.execute("""
+        insert into photo_files (filename, ref_count)
+        select unnest(%s::varchar[]), unnest(%s::int[])
+        on conflict (filename) do update
+        set ref_count = photo_files.ref_count + excluded.ref_count
+        returning filename, ref_count
+    """, (list(counts.keys()), list(counts.values())))
+    return list(map(lambda tuple: tuple[0], filter(lambda tuple: tuple[1] == counts[tuple[0]], cursor.fetchall())))
+
+def release_photo_files(cursor, photo_condition: str, params: tuple) -> None:
+    # Must run before the photos matching the condition are deleted.
+    # Files no longer used by any photo are removed by the worker.
+    # The locks are taken in the same order as in reference_photo_files, so uploads and deletes can't deadlock.
+    cursor.execute(f"""
+        select pg_advisory_xact_lock(hashtext(f.filename))
+        from (select distinct p.filename from photos p where {photo_condition} order by 1) f
+    """, params)
+    cursor.execute(f"""
+        update photo_files f
+        set ref_count = f.ref_count - d.photo_count
+        from (
+            select p.filename, count(*) as photo_count
+            from photos p
+            where {photo_condition}
+            group by p.filename
+        ) d
+        where f.filename = d.filename
+        returning f.filename, f.ref_count
+    """, params)
+    unused_filenames = list(map(lambda tuple: tuple[0], filter(lambda tuple: tuple[1] <= 0, cursor.fetchall())))
+
+    if len(unused_filenames) > 0:
+        cursor.execute('delete from photo_files where filename = any (%s)', (unused_filenames, ))
+        enqueue_job(cursor, 'remove_photo_files', {'filenames': unused_filenames})
+
+# Formatted with keyset_condition
+album_photos_query = """
+    select *
+    from photos p
+    where p.album_id = %s and {condition}
+    order by {order}
+    limit %s
+"""
+
+def get_photos_by_album_id(album_id: int, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['p.photo_id'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(album_photos_query.format(condition=condition, order=order), (album_id, *cursor_params, limit + 1))
     photos = dict_cursor.fetchall()
     dict_cursor.close()
-    return photos
-
-def get_photo_filename_by_photo_id(photo_id: int) -> str | None:
-    cursor = connection.cursor()
-    cursor.execute('select filename from photos p where p.photo_id = %s', (photo_id, ))
-    tuple = cursor.fetchone()
-    cursor.close()
-    if tuple is None:
-        return None
-    filename = tuple[0]
-    return filename
+    return make_page(photos, lambda photo: (photo['photo_id'], ), after, before, limit)
 
 def is_photo_in_album(photo_id: int, album_id: int) -> bool:
-    cursor = connection.cursor()
+    cursor = get_db().cursor()
     cursor.execute('select p.album_id from photos p where p.photo_id = %s', (photo_id, ))
     tuple = cursor.fetchone()
     cursor.close()
     return tuple is not None and tuple[0] == album_id
 
+friend_status_query = 'select count(*) as count from friends where user1_id = %s and user2_id = %s'
+
+@cached('friend_status', ttl=300)
 def get_friend_status(user1_id: int, user2_id: int) -> bool:
-    cursor = connection.cursor()
-    cursor.execute('select count(*) from friends where user1_id = %s and user2_id = %s', (user1_id, user2_id))
+    cursor = get_db().cursor()
+    cursor.execute(friend_status_query, (user1_id, user2_id))
     tuple = cursor.fetchone()
     cursor.close()
     return tuple[0] == 1
 
-def add_friend(user1_id: int, user2_id: int) -> None:
-    cursor = connection.cursor()
-    cursor.execute('insert into friends (user1_id, user2_id) values (%s, %s)', (user1_id, user2_id))
-    connection.commit()
+def add_friend(user1_id: int, user2_id: int) -> bool:
+    # Adding a friend twice does nothing the second time.
+    # Returns whether they are friends now, i.e. False only if user2 does not exist (or is user1).
+    cursor = get_db().cursor()
+    cursor.execute("""
+        with target as (
+            select u.user_id
+            from users u
+            where u.user_id = %(user2_id)s and u.user_id <> %(user1_id)s
+        ),
+        inserted as (
+            insert into friends (user1_id, user2_id)
+            select %(user1_id)s, t.user_id
+            from target t
+            on conflict do nothing
+            returning user2_id
+        )
+        select exists (select 1 from target), exists (select 1 from inserted)
+    """, {'user1_id': user1_id, 'user2_id': user2_id})
+    is_friend, is_inserted = cursor.fetchone()
+    if is_inserted:
+        update_friend_recommendations(cursor, user1_id, user2_id, 1)
+    get_db().commit()
     cursor.close()
-
-def remove_friend(user1_id: int, user2_id: int) -> None:
-    cursor = connection.cursor()
-    cursor.execute('delete from friends where user1_id = %s and user2_id = %s', (user1_id, user2_id))
-    connection.commit()
+    invalidate('friend_status', user1_id, user2_id)
+    return is_friend
+
+def remove_friend(user1_id: int, user2_id: int) -> bool:
+    # Removing a friend twice does nothing the second time. Returns whether they are friends now (never).
+    cursor = get_db().cursor()
+    cursor.execute('delete from friends where user1_id = %s and user2_id = %s returning user1_id', (user1_id, user2_id))
+    if cursor.fetchone() is not None:
+        update_friend_recommendations(cursor, user1_id, user2_id, -1)
+    get_db().commit()
     cursor.close()
+    invalidate('friend_status', user1_id, user2_id)
+    return False
+
+def update_friend_recommendations(cursor, user1_id: int, user2_id: int, delta: int) -> None:
+    """
+    Update the mutual friend counts after the edge user1 -> user2 was added (delta 1) or removed (delta -1).
+    The edge is a path user1 -> user2 -> c for every friend c of user2,
+    and a path u -> user1 -> user2 for every user u who has user1 as a friend.
+    """
+    # Lock the two users, who are the middle of every path counted here, until the end of the transaction.
+    # Otherwise an edge added at the same time on the other side of one of them (e.g. a -> user1 while
+    # user1 -> user2 is added) is invisible to both transactions and its path is never counted.
+    # The locks are taken in a fixed order, so two updates can't deadlock.
+    cursor.execute("""
+        select pg_advisory_xact_lock(hashtext('friend_recommendations'), u.user_id)
+        from (select distinct unnest(array[%s, %s]::integer[]) as user_id order by 1) u
+    """, (user1_id, user2_id))
+    cursor.execute("""
+        insert into friend_recommendations (user_id, candidate_id, mutual_count)
+        select %(user1_id)s::integer, f.user2_id, %(delta)s
+        from friends f
+        where f.user1_id = %(user2_id)s::integer and f.user2_id != %(user1_id)s::integer
+        union all
+        select f.user1_id, %(user2_id)s::integer, %(delta)s
+        from friends f
+        where f.user2_id = %(user1_id)s::integer and f.user1_id != %(user2_id)s::integer
+        on conflict (user_id, candidate_id) do update
+        set mutual_count = friend_recommendations.mutual_count + excluded.mutual_count
+    """, {'user1_id': user1_id, 'user2_id': user2_id, 'delta': delta})
+    cursor.execute("""
+        delete from friend_recommendations
+        where mutual_count <= 0 and (user_id = %s or candidate_id = %s)
+    """, (user1_id, user2_id))
 
 def get_user_friends(user_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
     dict_cursor.execute("""
         select u.user_id, u.first_name, u.last_name
         from friends f
@@ -271,116 +1075,311 @@ def get_user_friends(user_id: int) -> list[DictRow]:
     dict_cursor.close()
     return users
 
-def get_non_friends_by_first_or_last_name_containing(user_id: int, query: str) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def escape_like(text: str) -> str:
+    # Match the text literally in a like pattern
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def get_non_friends_by_first_or_last_name_containing(user_id: int, query: str, limit: int = page_size) -> list[DictRow]:
+    # The name expression must stay the same as in the users_full_name_trgm_idx index (see schema.sql)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
     dict_cursor.execute("""
         select u.user_id, u.first_name, u.last_name
         from users u
         where
-            (lower(concat(u.first_name, ' ', u.last_name)) like lower(concat('%%', %s, '%%')))
+            lower(u.first_name || ' ' || u.last_name) like %s
             and u.user_id != %s
-            and u.user_id not in (
-                select f.user2_id
+            and not exists (
+                select 1
                 from friends f
-                where f.user1_id = %s
+                where f.user1_id = %s and f.user2_id = u.user_id
             )
-    """, (query, user_id, user_id))
+        order by similarity(lower(u.first_name || ' ' || u.last_name), %s) desc, u.user_id
+        limit %s
+    """, (f'%{escape_like(query.lower())}%', user_id, user_id, query.lower(), limit))
     users = dict_cursor.fetchall()
     dict_cursor.close()
     return users
  
-def get_friend_recommendations(user_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def get_friend_recommendations(user_id: int, limit: int = page_size) -> list[DictRow]:
+    # People who are friends with at least two of the user's friends, see update_friend_recommendations
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
     dict_cursor.execute("""
-        select user_id, first_name, last_name    
-        from (
-            (
-                select user2_id
-                from (
-                    select user2_id as user_id
-                    from friends
-                    where user1_id = %s
-                ) my_friends
-                join friends f on my_friends.user_id = f.user1_id
-                where f.user2_id != %s
-            )
-            except all (
-                select user2_id
-                from friends
-                where user1_id = %s
+        select u.user_id, u.first_name, u.last_name
+        from friend_recommendations r
+        join users u on u.user_id = r.candidate_id
+        where r.user_id = %s
+            and r.mutual_count > 1
+            and not exists (
+                select 1
+                from friends f
+                where f.user1_id = r.user_id and f.user2_id = r.candidate_id
             )
-        ) friends_of_my_friends
-        join users u on u.user_id = friends_of_my_friends.user2_id
-        group by u.user_id
-        having count(*) > 1
-        order by count(*) desc
-    """, (user_id, user_id, user_id ))
+        order by r.mutual_count desc, r.candidate_id
+        limit %s
+    """, (user_id, limit))
     users = dict_cursor.fetchall()
     dict_cursor.close()
     return users
 
-def get_like_status(photo_id: int, user_id: int) -> bool:
-    cursor = connection.cursor()
-    cursor.execute('select count(*) from likes where user_id = %s and photo_id = %s', (user_id, photo_id))
-    tuple = cursor.fetchone()
+def rebuild_friend_recommendations() -> int:
+    # Load the whole friends graph as adjacency sets
+    cursor = get_db().cursor('friends_graph')
+    cursor.itersize = 10000
+    cursor.execute('select user1_id, user2_id from friends')
+    friends_of = {}
+    friend_of = {}
+    for user1_id, user2_id in cursor:
+        friends_of.setdefault(user1_id, set()).add(user2_id)
+        friend_of.setdefault(user2_id, set()).add(user1_id)
     cursor.close()
-    return tuple[0] == 1
 
-def like_photo(user_id: int, photo_id: int) -> None:
-    cursor = connection.cursor()
-    cursor.execute('insert into likes (user_id, photo_id) values (%s, %s)', (user_id, photo_id))
-    connection.commit()
+    cursor = get_db().cursor()
+    cursor.execute('delete from friend_recommendations')
+    row_count = 0
+
+    for user_id, friends in friends_of.items():
+        # Friends of friends, and how many friends each of them shares with the user
+        candidate_ids = set().union(*map(lambda friend_id: friends_of.get(friend_id, set()), friends))
+        candidate_ids.discard(user_id)
+        rows = list(map(lambda candidate_id: (user_id, candidate_id, len(friends & friend_of[candidate_id])), candidate_ids))
+        psycopg2.extras.execute_values(cursor, 'insert into friend_recommendations (user_id, candidate_id, mutual_count) values %s', rows)
+        row_count += len(rows)
+
+    # Commit once so the old recommendations stay visible until the new ones are complete
+    get_db().commit()
     cursor.close()
+    return row_count
+
+liked_photo_ids_query = 'select photo_id from likes where user_id = %s and photo_id = any (%s)'
+
+def get_liked_photo_ids(photo_ids: list[int], user_id: int) -> set[int]:
+    cursor = get_db().cursor()
+    cursor.execute(liked_photo_ids_query, (user_id, photo_ids))
+    tuples = cursor.fetchall()
+    cursor.close()
+    return set(map(lambda tuple: tuple[0], tuples))
+
+def like_photo(user_id: int, photo_id: int) -> int | None:
+    # Liking twice does nothing the second time, so double clicks and retries are safe
+    return set_photo_like(user_id, photo_id, """
+        insert into likes (user_id, photo_id)
+        select %(user_id)s, p.photo_id
+        from photos p
+        where p.photo_id = %(photo_id)s
+        on conflict do nothing
+        returning photo_id
+    """, 1)
     
-def unlike_photo(user_id: int, photo_id: int) -> None:
-    cursor = connection.cursor()
-    cursor.execute('delete from likes where user_id = %s and photo_id = %s', (user_id, photo_id))
-    connection.commit()
+def unlike_photo(user_id: int, photo_id: int) -> int | None:
+    return set_photo_like(user_id, photo_id, """
+        delete from likes
+        where user_id = %(user_id)s and photo_id = %(photo_id)s
+        returning photo_id
+    """, -1)
+
+def set_photo_like(user_id: int, photo_id: int, change_query: str, like_delta: int) -> int | None:
+    """
+    Run the like change and, only if it changed a row, update the photo's counter and version, all in one statement.
+    Returns the new like count, or None if the photo does not exist.
+    """
+    cursor = get_db().cursor()
+    try:
+        # The last select sees the photo as it was before the statement, which is right when nothing changed
+        cursor.execute(f"""
+            with changed as ({change_query}),
+            updated as (
+                update photos p
+                set like_count = p.like_count + %(like_delta)s, version = p.version + 1
+                from changed c
+                where p.photo_id = c.photo_id
+                returning p.like_count
+            )
+            select coalesce((select u.like_count from updated u), (select p.like_count from photos p where p.photo_id = %(photo_id)s))
+        """, {'user_id': user_id, 'photo_id': photo_id, 'like_delta': like_delta})
+        like_count = cursor.fetchone()[0]
+    except psycopg2.Error:
+        # e.g. the photo was deleted in the meantime
+        get_db().rollback()
+        cursor.close()
+        return None
+
+    get_db().commit()
+    cursor.close()
+    return like_count
+
+def update_photo_counts(cursor, photo_id: int, like_delta: int, comment_delta: int) -> None:
+    # Keep the like and comment counters of a photo in step with the likes and comments tables, and bump its version
+    cursor.execute("""
+        update photos
+        set like_count = like_count + %s, comment_count = comment_count + %s, version = version + 1
+        where photo_id = %s
+    """, (like_delta, comment_delta, photo_id))
+
+def rebuild_photo_counts() -> int:
+    # Recount the likes and comments of every photo whose counters drifted (e.g. after users were deleted).
+    # Returns how many photos were fixed.
+    cursor = get_db().cursor()
+    cursor.execute("""
+        update photos p
+        set like_count = e.like_count, comment_count = e.comment_count, version = p.version + 1
+        from (
+            select p.photo_id,
+                (select count(*) from likes l where l.photo_id = p.photo_id) as like_count,
+                (select count(*) from comments c where c.photo_id = p.photo_id) as comment_count
+            from photos p
+        ) e
+        where p.photo_id = e.photo_id and (p.like_count, p.comment_count) <> (e.like_count, e.comment_count)
+    """)
+    row_count = cursor.rowcount
+    get_db().commit()
     cursor.close()
+    return row_count
 
 def get_photo_info(photos: list[DictRow], set_album_owner_id: bool, set_like_info: bool, set_comments: bool, set_tags: bool) -> list[dict]:
     user_id = None if g.user is None else g.user['user_id']
-    new_photos = []
-
-    for photo in photos:
-        photo = dict(photo)
-        new_photos.append(photo)
+    new_photos = list(map(dict, photos))
+    photo_ids = list(map(lambda photo: photo['photo_id'], new_photos))
+
+    if len(photo_ids) == 0:
+        return new_photos
+
+    # Fetch every attribute for all the photos at once (one query per attribute),
+    # then assemble the dicts in memory
+    if set_album_owner_id:
+        owner_ids = get_photos_album_owner_ids(photo_ids)
+    if set_like_info:
+        liked_photo_ids = set() if user_id is None else get_liked_photo_ids(photo_ids, user_id)
+        liked_users = get_names_of_users_who_liked_photos(photo_ids)
+    if set_comments:
+        comments = get_photos_comments(photo_ids)
+    if set_tags:
+        tag_labels = get_photos_tag_labels(photo_ids)
+
+    for photo in new_photos:
         photo_id = photo['photo_id']
 
         if set_album_owner_id:
             # Set album owner id
-            photo['owner_id'] = get_photo_album_owner_id(photo_id)
+            photo['owner_id'] = owner_ids[photo_id]
 
         if set_like_info:
-            # Set like status
-            photo['is_liked'] = False if user_id is None else get_like_status(photo_id, user_id)
-            # Get and set users who liked
-            photo['liked_users'] = get_names_of_users_who_liked_photo(photo_id)
+            # Set like status and users who liked
+            photo['is_liked'] = photo_id in liked_photo_ids
+            photo['liked_users'] = liked_users.get(photo_id, [])
 
         if set_comments:
-            # Get and set comments
-            photo['comments'] = get_photo_comments(photo_id)
+            # Set comments
+            photo['comments'] = comments.get(photo_id, [])
 
         if set_tags:
-            # Get and set tags
-            photo['tag_labels'] = get_photo_tag_labels(photo_id)
+            # Set tags
+            photo['tag_labels'] = tag_labels.get(photo_id, [])
 
     return new_photos
 
-def get_names_of_users_who_liked_photo(photo_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select u.first_name, u.last_name
-        from users u
-        join likes l on u.user_id = l.user_id
-        where l.photo_id = %s
-    """, (photo_id, ))
+def get_photo_cards(photos: list[DictRow], owner_id: int | None = None) -> list[dict]:
+    """
+    Prepare photos for the photo_card macro (see photo_card.jinja).
+    The parts of a card that are the same for every viewer come from the fragment cache, keyed by the photo version,
+    so the likers, comments and tags are only fetched and rendered for the photos that are not cached.
+    Pass owner_id if all the photos have the same owner.
+    """
+    user_id = None if g.user is None else g.user['user_id']
+    new_photos = list(map(dict, photos))
+    photo_ids = list(map(lambda photo: photo['photo_id'], new_photos))
+
+    if len(photo_ids) == 0:
+        return new_photos
+
+    # The viewer specific parts are always fetched
+    owner_ids = {} if owner_id is not None else get_photos_album_owner_ids(photo_ids)
+    liked_photo_ids = set() if user_id is None else get_liked_photo_ids(photo_ids, user_id)
+    missing_photos = []
+
+    for photo in new_photos:
+        if not load_photo_card(photo, owner_id if owner_id is not None else owner_ids[photo['photo_id']], user_id, liked_photo_ids):
+            missing_photos.append(photo)
+
+    if len(missing_photos) == 0:
+        return new_photos
+
+    # Render the cards that are not cached
+    missing_photo_ids = list(map(lambda photo: photo['photo_id'], missing_photos))
+    liked_users = get_names_of_users_who_liked_photos(missing_photo_ids)
+    comments = get_photos_comments(missing_photo_ids)
+    tag_labels = get_photos_tag_labels(missing_photo_ids)
+
+    for photo in missing_photos:
+        set_photo_card_parts(photo, liked_users, comments, tag_labels)
+        store_photo_card(photo, {
+            'head': get_template_attribute('photo_card.jinja', 'card_head')(photo, photo['is_owner_view']),
+            'likers': get_template_attribute('photo_card.jinja', 'card_likers')(photo),
+            'comments': get_template_attribute('photo_card.jinja', 'card_comments')(photo),
+        })
+
+    return new_photos
+
+# The steps of get_photo_cards that don't read the database, shared with asgi.py so both apps cache the same cards
+
+def get_photo_card_key(photo: dict) -> str:
+    # Tag links differ for the owner, so they get their own version of the card
+    return get_cache_key('photo_card', photo['photo_id'], photo['version'], int(photo['is_owner_view']))
+
+def load_photo_card(photo: dict, owner_id: int, user_id: int | None, liked_photo_ids: set[int]) -> bool:
+    # Set the viewer specific fields, and the card if it is cached. Returns whether it was.
+    photo['owner_id'] = owner_id
+    photo['is_liked'] = photo['photo_id'] in liked_photo_ids
+    photo['is_owner_view'] = user_id is not None and user_id == owner_id
+
+    hit, card = cache.get(get_photo_card_key(photo))
+    record_cache_lookup('photo_card', hit)
+    if hit:
+        photo['card'] = dict(map(lambda item: (item[0], Markup(item[1])), card.items()))
+    return hit
+
+def set_photo_card_parts(photo: dict, liked_users: dict, comments: dict, tag_labels: dict) -> None:
+    # What the card macros need, from the batch lookups keyed by photo id
+    photo_id = photo['photo_id']
+    photo['liked_users'] = liked_users.get(photo_id, [])
+    photo['comments'] = comments.get(photo_id, [])
+    photo['tag_labels'] = tag_labels.get(photo_id, [])
+
+def store_photo_card(photo: dict, card: dict) -> None:
+    # card has the rendered head, likers and comments macros
+    card = dict(map(lambda item: (item[0], str(item[1])), card.items()))
+    cache.set(get_photo_card_key(photo), card, photo_card_ttl)
+    photo['card'] = dict(map(lambda item: (item[0], Markup(item[1])), card.items()))
+
+def group_rows_by_photo_id(rows: list) -> dict[int, list]:
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['photo_id'], []).append(row)
+    return groups
+
+card_likers_query = """
+    select p.photo_id, u.first_name, u.last_name
+    from unnest(%s::integer[]) p (photo_id)
+    cross join lateral (
+        select l.user_id
+        from likes l
+        where l.photo_id = p.photo_id
+        order by l.user_id
+        limit %s
+    ) l
+    join users u on u.user_id = l.user_id
+    order by p.photo_id, l.user_id
+"""
+
+def get_names_of_users_who_liked_photos(photo_ids: list[int], limit: int = card_liker_count) -> dict[int, list[DictRow]]:
+    # At most limit likers per photo, read from the likes index, so photos with many likes cost the same
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(card_likers_query, (photo_ids, limit))
     names = dict_cursor.fetchall()
     dict_cursor.close()
-    return names
+    return group_rows_by_photo_id(names)
 
 def add_comment(user_id: int, photo_id: int, text: str) -> bool:
-    cursor = connection.cursor()
+    cursor = get_db().cursor()
     error = None
 
     try:
@@ -388,10 +1387,12 @@ def add_comment(user_id: int, photo_id: int, text: str) -> bool:
             insert into comments (text, creation_date, photo_id, user_id)
             values (%s, now(), %s,%s)
         """, (text, photo_id, user_id))
+        update_user_score(cursor, user_id, 1, 0)
+        update_photo_counts(cursor, photo_id, 0, 1)
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
+    get_db().commit()
     cursor.close()
 
     if error is not None:
@@ -400,33 +1401,99 @@ def add_comment(user_id: int, photo_id: int, text: str) -> bool:
 
     return True
 
-def get_photo_comments(photo_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select c.text, c.creation_date, u.first_name, u.last_name 
+card_comments_query = """
+    select p.photo_id, c.text, c.creation_date, u.first_name, u.last_name
+    from unnest(%s::integer[]) p (photo_id)
+    cross join lateral (
+        select c.comment_id, c.text, c.creation_date, c.user_id
         from comments c
-        join users u on c.user_id = u.user_id
-        where c.photo_id = %s
-    """, (photo_id, ))
+        where c.photo_id = p.photo_id
+        order by c.comment_id desc
+        limit %s
+    ) c
+    join users u on c.user_id = u.user_id
+    order by p.photo_id, c.comment_id
+"""
+
+def get_photos_comments(photo_ids: list[int], limit: int = card_comment_count) -> dict[int, list[DictRow]]:
+    # The latest limit comments of each photo, oldest first
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(card_comments_query, (photo_ids, limit))
     comments = dict_cursor.fetchall()
     dict_cursor.close()
-    return comments
+    return group_rows_by_photo_id(comments)
 
-def get_users_by_comments_containing(query: str) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select u.user_id, u.first_name, u.last_name, m.match_count
-        from (
-            select c.user_id, count(*) as match_count
-            from comments c
-            where c.text like concat('%%', %s, '%%')
-            group by c.user_id
-        ) m
-        join users u on u.user_id = m.user_id
-        order by m.match_count desc
-    """, (query, ))
+def get_photo_likers(photo_id: int, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['l.user_id'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(f"""
+        select u.user_id, u.first_name, u.last_name
+        from likes l
+        join users u on u.user_id = l.user_id
+        where l.photo_id = %s and {condition}
+        order by {order}
+        limit %s
+    """, (photo_id, *cursor_params, limit + 1))
     users = dict_cursor.fetchall()
     dict_cursor.close()
+    return make_page(users, lambda user: (user['user_id'], ), after, before, limit)
+
+def get_photo_comments(photo_id: int, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['c.comment_id'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(f"""
+        select c.comment_id, c.text, c.creation_date, u.user_id, u.first_name, u.last_name
+        from comments c
+        join users u on u.user_id = c.user_id
+        where c.photo_id = %s and {condition}
+        order by {order}
+        limit %s
+    """, (photo_id, *cursor_params, limit + 1))
+    comments = dict_cursor.fetchall()
+    dict_cursor.close()
+    return make_page(comments, lambda comment: (comment['comment_id'], ), after, before, limit)
+
+# Markers around the matched words in snippets, replaced with <mark> after the snippet is escaped
+snippet_start_marker = '\x02'
+snippet_stop_marker = '\x03'
+
+def get_users_by_comments_containing(query: str, limit: int = page_size) -> list[dict]:
+    # Uses the full-text index on comments, users are ranked by how well their comments match
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute("""
+        with matches as (
+            select c.user_id, c.text, ts_rank(c.text_search, q.query) as rank, q.query
+            from comments c, websearch_to_tsquery('english', %s) q(query)
+            where c.text_search @@ q.query
+        ),
+        user_matches as (
+            select m.user_id, count(*) as match_count, sum(m.rank) as rank
+            from matches m
+            group by m.user_id
+            order by rank desc, m.user_id
+            limit %s
+        )
+        select u.user_id, u.first_name, u.last_name, um.match_count,
+            ts_headline('english', best.text, best.query, %s) as snippet
+        from user_matches um
+        join users u on u.user_id = um.user_id
+        join lateral (
+            select m.text, m.query
+            from matches m
+            where m.user_id = um.user_id
+            order by m.rank desc
+            limit 1
+        ) best on true
+        order by um.rank desc, um.user_id
+    """, (query, limit, f'StartSel={snippet_start_marker}, StopSel={snippet_stop_marker}, MaxWords=25, MinWords=10'))
+    users = list(map(dict, dict_cursor.fetchall()))
+    dict_cursor.close()
+
+    # Comments are user input, so escape them before adding the highlighting
+    for user in users:
+        snippet = str(escape(user['snippet']))
+        user['snippet'] = Markup(snippet.replace(snippet_start_marker, '<mark>').replace(snippet_stop_marker, '</mark>'))
+
     return users
 
 def parse_tags_string(tags_string: str) -> list[str]:
@@ -439,67 +1506,23 @@ def parse_tags_string(tags_string: str) -> list[str]:
 
     return a
 
-def does_tag_exist(label: str) -> bool:
-    cursor = connection.cursor()
-    cursor.execute('select count(*) from tags where label = %s', (label, ))
-    tuple = cursor.fetchone()
-    cursor.close()
-    return tuple[0] == 1
-
-def add_tag(label: str) -> bool:
-    cursor = connection.cursor()
-    error = None
-    
-    try:
-        cursor.execute('insert into tags (label) values (%s)', (label, ))
-    except psycopg2.errors.UniqueViolation:
-        error = 'That tag already exists. Please try again with the same tags'
-    except psycopg2.errors.CheckViolation:
-        error = 'Invalid tag. Please try with another tag'
-    except Exception as e:
-        error = f'An error occurred. Please try again later. Error: {e}'
-
-    connection.commit()
-    cursor.close()
-
-    if error is not None:
-        flash(error)
-        return False
-
-    return True
-
-def add_photo_tag(photo_id: int, tag_label: str) -> bool:
-    cursor = connection.cursor()
-    error = None
-    
-    try:
-        cursor.execute('insert into photo_tags (tag_label, photo_id) values (%s, %s)', (tag_label, photo_id))
-    except Exception as e:
-        error = f'An error occurred. Please try again later. Error: {e}'
-
-    connection.commit()
-    cursor.close()
+photos_tag_labels_query = """
+    select pt.photo_id, array_agg(pt.tag_label) as tag_labels
+    from photo_tags pt
+    where pt.photo_id = any (%s)
+    group by pt.photo_id
+"""
 
-    if error is not None:
-        flash(error)
-        return False
-
-    return True
-
-def get_photo_tag_labels(photo_id: int) -> list[str]:
-    cursor = connection.cursor()
-    cursor.execute("""
-        select pt.tag_label
-        from photo_tags pt
-        where pt.photo_id = %s
-    """, (photo_id, ))
+def get_photos_tag_labels(photo_ids: list[int]) -> dict[int, list[str]]:
+    cursor = get_db().cursor()
+    cursor.execute(photos_tag_labels_query, (photo_ids, ))
     tuples = cursor.fetchall()
     cursor.close()
-    tag_labels = list(map(lambda tuple: tuple[0], tuples))
-    return tag_labels
+    return dict(tuples)
 
+@cached('famous_tags', ttl=60)
 def get_famous_tags(tag_count: int) -> list[str]:
-    cursor = connection.cursor()
+    cursor = get_db().cursor()
     cursor.execute("""
         select pt.tag_label 
         from photo_tags pt
@@ -512,90 +1535,509 @@ def get_famous_tags(tag_count: int) -> list[str]:
     tag_labels = list(map(lambda tuple: tuple[0], tuples))
     return tag_labels
 
-def get_all_photos_by_tags(tags: list[str]) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select * 
-        from photos p
-        where %s = (
-            select count(*)
-            from photo_tags pt
-            where pt.photo_id = p.photo_id
-            and pt.tag_label = any (%s)                
-        ) 
-    """, (len(tags), tags))
-    photos = dict_cursor.fetchall()
-    dict_cursor.close()
-    return photos
+def parse_tag_query(query: str) -> list[tuple[list[str], list[str]]] | None:
+    """
+    Parse a tag search such as 'beach sunset OR mountain NOT snow'.
+    Tags separated by spaces must all match, OR separates alternatives and NOT excludes the tag after it.
+    Returns the alternatives as (required tags, excluded tags) pairs.
+    """
+    clauses = []
+
+    for clause_string in re.split(r'\s+OR\s+', query.strip()):
+        required = []
+        excluded = []
+        is_negated = False
+
+        for word in clause_string.split():
+            # A leftover OR has no tags on one of its sides, NOT NOT is a typo
+            if word == 'OR' or (word == 'NOT' and is_negated):
+                return None
+            if word == 'NOT':
+                is_negated = True
+                continue
+            tag_label = word.lower()
+            if not re.match(r'^[a-z]+$', tag_label):
+                return None
+            (excluded if is_negated else required).append(tag_label)
+            is_negated = False
+
+        # A NOT at the end has no tag to exclude
+        if is_negated:
+            return None
 
-def get_user_photos_by_tags(tags: list[str], user_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select * 
-        from photos p
-        join albums a on p.album_id = a.album_id
-        where a.owner_id = %s 
-        and %s = (
+        # Every alternative needs at least one tag to start the search from
+        if len(required) == 0:
+            return None
+        clauses.append((required, excluded))
+
+    return clauses
+
+def get_tag_photo_counts(tag_labels: list[str], user_id: int | None, max_count: int = tag_count_limit) -> dict[str, int]:
+    # Counts stop at max_count, enough to tell rare tags from common ones without reading a common tag's whole posting list
+    owner_join = '' if user_id is None else 'join photos p on p.photo_id = pt.photo_id join albums a on a.album_id = p.album_id'
+    owner_condition = 'true' if user_id is None else 'a.owner_id = %(user_id)s'
+    cursor = get_db().cursor()
+    cursor.execute(f"""
+        select t.tag_label, (
             select count(*)
-            from photo_tags pt
-            where pt.photo_id = p.photo_id
-            and pt.tag_label = ANY (%s)                
-        ) 
-    """, (user_id, len(tags), tags))
-    photos = dict_cursor.fetchall()
-    dict_cursor.close()
-    return photos
+            from (
+                select 1
+                from photo_tags pt
+                {owner_join}
+                where pt.tag_label = t.tag_label and {owner_condition}
+                limit %(max_count)s
+            ) c
+        )
+        from unnest(%(tag_labels)s::text[]) t (tag_label)
+    """, {'tag_labels': tag_labels, 'user_id': user_id, 'max_count': max_count})
+    tuples = cursor.fetchall()
+    cursor.close()
+    return dict(tuples)
+
+def get_tags_of_photos_with_tag(tag_label: str, tag_labels: list[str], user_id: int | None) -> dict[int, set[str]]:
+    # Start from the photos with one tag and find which of the other tags each of them has
+    owner_join = '' if user_id is None else 'join photos p on p.photo_id = r.photo_id join albums a on a.album_id = p.album_id'
+    owner_condition = 'true' if user_id is None else 'a.owner_id = %s'
+    cursor = get_db().cursor()
+    cursor.execute(f"""
+        select pt.photo_id, array_agg(pt.tag_label)
+        from photo_tags pt
+        where pt.photo_id in (
+            select r.photo_id
+            from photo_tags r
+            {owner_join}
+            where r.tag_label = %s and {owner_condition}
+        )
+        and pt.tag_label = any (%s)
+        group by pt.photo_id
+    """, (tag_label, tag_labels) if user_id is None else (tag_label, user_id, tag_labels))
+    tuples = cursor.fetchall()
+    cursor.close()
+    return dict(map(lambda tuple: (tuple[0], set(tuple[1])), tuples))
 
-def get_recommended_photos(tag_labels: list[str], user_id: int) -> list[DictRow]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select p.photo_id, p.caption, p.filename, p.album_id
-        from (
-            select pt.photo_id
-            from photo_tags pt
-            where pt.tag_label = any (%s)
-            group by pt.photo_id
-            order by count(*) desc
-        ) valid_photo_ids
-        join photos p on p.photo_id = valid_photo_ids.photo_id
-        join photo_tags pt on pt.photo_id = valid_photo_ids.photo_id
+def search_photo_ids_by_tags(clauses: list[tuple[list[str], list[str]]], user_id: int | None) -> list[int]:
+    """
+    Find the photos matching any of the alternatives of a parsed tag query with OR.
+    Each alternative starts from the posting list of its rarest tag, so common tags never get scanned.
+    Photos matching more of the searched tags come first.
+    """
+    required_tag_labels = sorted(set(tag_label for required, _ in clauses for tag_label in required))
+    all_tag_labels = sorted(set(tag_label for required, excluded in clauses for tag_label in required + excluded))
+    counts = get_tag_photo_counts(required_tag_labels, user_id)
+    matches = {}
+
+    for required, excluded in clauses:
+        # No photo has one of the tags, so nothing can match
+        if any(map(lambda tag_label: counts.get(tag_label, 0) == 0, required)):
+            continue
+
+        rarest_tag_label = min(required, key=lambda tag_label: counts[tag_label])
+        photos_tags = get_tags_of_photos_with_tag(rarest_tag_label, all_tag_labels, user_id)
+
+        for photo_id, tag_labels in photos_tags.items():
+            if tag_labels.issuperset(required) and tag_labels.isdisjoint(excluded):
+                matches[photo_id] = tag_labels
+
+    required_tag_labels = set(required_tag_labels)
+    return sorted(matches, key=lambda photo_id: (-len(matches[photo_id] & required_tag_labels), photo_id))
+
+def get_photos_with_tags(required: list[str], excluded: list[str], user_id: int | None, after: tuple | None, before: tuple | None, limit: int) -> tuple[list[DictRow], str | None, str | None]:
+    """
+    One page of the photos with all the required tags and none of the excluded ones, in photo id order.
+    Walks the posting list of the first required tag from the cursor, so pass the rarest one first.
+    """
+    condition, order, cursor_params, after, before = keyset_condition(['pt.photo_id'], after, before)
+    owner_condition = 'true' if user_id is None else 'a.owner_id = %s'
+    required_conditions = ' '.join(map(lambda _: 'and exists (select 1 from photo_tags t where t.photo_id = pt.photo_id and t.tag_label = %s)', required[1:]))
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(f"""
+        select p.*
+        from photo_tags pt
+        join photos p on p.photo_id = pt.photo_id
         join albums a on a.album_id = p.album_id
-        where a.owner_id != %s
-        group by p.photo_id
-        order by count(*) asc
-    """, (tag_labels, user_id))
+        where pt.tag_label = %s and {owner_condition} and {condition}
+        {required_conditions}
+        and not exists (select 1 from photo_tags t where t.photo_id = pt.photo_id and t.tag_label = any (%s))
+        order by {order}
+        limit %s
+    """, (required[0], *([] if user_id is None else [user_id]), *cursor_params, *required[1:], excluded, limit + 1))
     photos = dict_cursor.fetchall()
     dict_cursor.close()
-    return photos
+    return make_page(photos, lambda photo: (photo['photo_id'], ), after, before, limit)
 
-def get_user_top_tags(user_id: int, tag_count: int) -> list[str]:
-    dict_cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    dict_cursor.execute("""
-        select pt.tag_label
+def get_photos_by_photo_ids(photo_ids: list[int]) -> list[DictRow]:
+    # Returns the photos in the same order as the ids
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute('select * from photos p where p.photo_id = any (%s)', (photo_ids, ))
+    photos = dict(map(lambda photo: (photo['photo_id'], photo), dict_cursor.fetchall()))
+    dict_cursor.close()
+    return [photos[photo_id] for photo_id in photo_ids if photo_id in photos]
+
+def search_photos_by_tags(clauses: list[tuple[list[str], list[str]]], user_id: int | None, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[DictRow], str | None, str | None]:
+    if len(clauses) == 1:
+        # Every hit has the same required tags, so there is nothing to rank and the page is a keyset query
+        required, excluded = clauses[0]
+        if len(required) > 1:
+            counts = get_tag_photo_counts(required, user_id)
+            required = sorted(required, key=lambda tag_label: counts.get(tag_label, 0))
+        return get_photos_with_tags(required, excluded, user_id, after, before, limit)
+
+    # With OR, photos matching more of the searched tags come first, so all the hits are ranked in memory
+    photo_ids = search_photo_ids_by_tags(clauses, user_id)
+
+    # The results are ordered by match count, so the photo id cursor is looked up in the ordered list.
+    # The slice mimics what a keyset query would fetch for make_page.
+    start = 0
+    if before is not None and len(before) == 1 and before[0] in photo_ids:
+        end = photo_ids.index(before[0])
+        page_ids = photo_ids[max(0, end - limit - 1):end][::-1]
+    else:
+        before = None
+        if after is not None and len(after) == 1 and after[0] in photo_ids:
+            start = photo_ids.index(after[0]) + 1
+        else:
+            after = None
+        page_ids = photo_ids[start:start + limit + 1]
+
+    photos = get_photos_by_photo_ids(page_ids)
+    return make_page(photos, lambda photo: (photo['photo_id'], ), after, before, limit)
+
+def get_user_tag_counts(user_id: int, tag_count: int) -> list[tuple[str, int]]:
+    cursor = get_db().cursor()
+    cursor.execute("""
+        select pt.tag_label, count(*)
         from photo_tags pt
         join photos p on p.photo_id = pt.photo_id
         join albums a on a.album_id = p.album_id
         where a.owner_id = %s
         group by pt.tag_label
-        order by count(*) desc
+        order by count(*) desc, pt.tag_label
         limit %s
     """, (user_id, tag_count))
-    tuples = dict_cursor.fetchall()
+    tag_counts = cursor.fetchall()
+    cursor.close()
+    return tag_counts
+
+def compute_photo_recommendations(user_id: int) -> None:
+    """
+    Score photos by how well their tags match the tags the user uses the most, and store the best ones.
+    The user is a sparse vector of tag weights (share of their top tags), each photo a sparse 0/1 vector of its tags.
+    A photo's score is the dot product of the two, divided by the square root of the photo's tag count
+    so photos with only a few, relevant tags rank higher.
+    """
+    tag_counts = get_user_tag_counts(user_id, recommendation_tag_count)
+    tag_labels = list(map(lambda tag_count: tag_count[0], tag_counts))
+    total = sum(map(lambda tag_count: tag_count[1], tag_counts))
+    weights = list(map(lambda tag_count: tag_count[1] / total, tag_counts))
+
+    cursor = get_db().cursor()
+
+    # Another request may be computing the same user, the loser of the insert leaves it to them.
+    # The change counters are read before the candidates, so a change in between makes the state stale, not lost.
+    cursor.execute("""
+        insert into photo_recommendation_states (user_id, top_tags, tag_change_count, computed_at)
+        select %(user_id)s, %(tag_labels)s, coalesce(sum(c.change_count), 0), now()
+        from tag_changes c
+        where c.tag_label = any (%(tag_labels)s::varchar[])
+        on conflict do nothing
+        returning user_id
+    """, {'user_id': user_id, 'tag_labels': tag_labels})
+
+    if cursor.fetchone() is not None and len(tag_labels) > 0:
+        cursor.execute("""
+            insert into photo_recommendations (user_id, rank, photo_id, score)
+            select %(user_id)s, row_number() over (order by s.score desc, s.photo_id), s.photo_id, s.score
+            from (
+                select pt.photo_id, sum(w.weight) / sqrt(max(photo_tag_count.tag_count)) as score
+                from unnest(%(tag_labels)s::varchar[], %(weights)s::float8[]) w(tag_label, weight)
+                join photo_tags pt on pt.tag_label = w.tag_label
+                join photos p on p.photo_id = pt.photo_id
+                join albums a on a.album_id = p.album_id
+                join lateral (
+                    select count(*) as tag_count
+                    from photo_tags all_pt
+                    where all_pt.photo_id = pt.photo_id
+                ) photo_tag_count on true
+                where a.owner_id != %(user_id)s
+                group by pt.photo_id
+                order by score desc, pt.photo_id
+                limit %(limit)s
+            ) s
+        """, {'user_id': user_id, 'tag_labels': tag_labels, 'weights': weights, 'limit': recommendation_candidate_count})
+
+    get_db().commit()
+    cursor.close()
+
+def get_photo_recommendation_top_tags(user_id: int) -> list[str] | None:
+    # Returns None if the recommendations were never computed.
+    # Stale recommendations (photos with the top tags changed since) are still returned. Once they are older than
+    # STALE_SECONDS, a refresh is queued for the worker.
+    cursor = get_db().cursor()
+    cursor.execute("""
+        select s.top_tags, s.computed_at < now() - %s * interval '1 second' and s.tag_change_count <> (
+            select coalesce(sum(c.change_count), 0)
+            from tag_changes c
+            where c.tag_label = any (s.top_tags)
+        )
+        from photo_recommendation_states s
+        where s.user_id = %s
+    """, (recommendation_stale_seconds, user_id))
+    tuple = cursor.fetchone()
+
+    if tuple is not None and tuple[1]:
+        # Move computed_at forward, so the requests until the worker gets to it don't queue the refresh again
+        cursor.execute("""
+            update photo_recommendation_states
+            set computed_at = now()
+            where user_id = %s and computed_at < now() - %s * interval '1 second'
+            returning user_id
+        """, (user_id, recommendation_stale_seconds))
+        if cursor.fetchone() is not None:
+            enqueue_job(cursor, 'compute_photo_recommendations', {'user_id': user_id})
+        get_db().commit()
+
+    cursor.close()
+    return None if tuple is None else tuple[0]
+
+def invalidate_photo_recommendations(cursor, photo_condition: str, params: tuple) -> None:
+    # Must run in the transaction that changes the photos matching the condition (before deleting them).
+    # The owner's top tags may change, so their recommendations are deleted. The candidates of everyone
+    # whose top tags the photos have may change too, but there can be any number of them, so only the
+    # change counters of the tags are bumped and their refresh is queued on their next visit.
+    # The counters are bumped in a fixed order, so two writes can't deadlock.
+    cursor.execute(f"""
+        delete from photo_recommendation_states s
+        where s.user_id in (
+            select a.owner_id
+            from photos p
+            join albums a on a.album_id = p.album_id
+            where {photo_condition}
+        )
+    """, params)
+    cursor.execute(f"""
+        insert into tag_changes (tag_label, change_count)
+        select t.tag_label, 1
+        from (
+            select distinct pt.tag_label
+            from photo_tags pt
+            join photos p on p.photo_id = pt.photo_id
+            where {photo_condition}
+            order by 1
+        ) t
+        on conflict (tag_label) do update
+        set change_count = tag_changes.change_count + 1
+    """, params)
+
+def get_recommended_photos(user_id: int, after: tuple | None = None, before: tuple | None = None, limit: int = page_size) -> tuple[list[str], list[DictRow], str | None, str | None]:
+    # Compute the candidates on the first visit, then every page is a read by rank
+    top_tags = get_photo_recommendation_top_tags(user_id)
+    if top_tags is None:
+        compute_photo_recommendations(user_id)
+        top_tags = get_photo_recommendation_top_tags(user_id) or []
+
+    condition, order, cursor_params, after, before = keyset_condition(['r.rank'], after, before)
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cursor.execute(f"""
+        select p.photo_id, p.caption, p.filename, p.album_id, p.version, p.like_count, p.comment_count, r.rank
+        from photo_recommendations r
+        join photos p on p.photo_id = r.photo_id
+        where r.user_id = %s and {condition}
+        order by {order}
+        limit %s
+    """, (user_id, *cursor_params, limit + 1))
+    photos = dict_cursor.fetchall()
     dict_cursor.close()
-    tag_labels = list(map(lambda tuple: tuple[0], tuples))
-    return tag_labels
+    return top_tags, *make_page(photos, lambda photo: (photo['rank'], ), after, before, limit)
+
+def enqueue_job(cursor, kind: str, payload: dict) -> None:
+    # Runs in the caller's transaction, so the job only exists if the write that needs it is committed
+    cursor.execute('insert into jobs (kind, payload) values (%s, %s)', (kind, psycopg2.extras.Json(payload)))
+
+def claim_job() -> DictRow | None:
+    # Hide the job from other workers until its lease runs out. If the worker dies, it is picked up again.
+    dict_cursor = get_db().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    # A job whose lease ran out after its last attempt never reached fail_job, most likely because it
+    # killed the worker (e.g. out of memory), so running it again would only kill the next one
+    dict_cursor.execute("""
+        update jobs
+        set status = 'failed', last_error = 'The worker stopped during attempt ' || attempts
+        where status = 'pending' and run_at <= now() and attempts >= %s
+    """, (job_max_attempts, ))
+    dict_cursor.execute("""
+        update jobs
+        set attempts = attempts + 1, run_at = now() + %s * interval '1 second'
+        where job_id = (
+            select j.job_id
+            from jobs j
+            where j.status = 'pending' and j.run_at <= now() and j.attempts < %s
+            order by j.run_at
+            limit 1
+            for update skip locked
+        )
+        returning job_id, kind, payload, attempts
+    """, (job_lease_seconds, job_max_attempts))
+    job = dict_cursor.fetchone()
+    get_db().commit()
+    dict_cursor.close()
+    return job
+
+def complete_job(job_id: int) -> None:
+    cursor = get_db().cursor()
+    cursor.execute('delete from jobs where job_id = %s', (job_id, ))
+    get_db().commit()
+    cursor.close()
+
+def fail_job(job: DictRow, error: str) -> None:
+    # Retry with exponential backoff until the job runs out of attempts
+    cursor = get_db().cursor()
+    cursor.execute("""
+        update jobs
+        set status = case when attempts >= %s then 'failed' else 'pending' end,
+            run_at = now() + %s * interval '1 second',
+            last_error = %s
+        where job_id = %s
+    """, (job_max_attempts, job_retry_seconds * 2 ** (job['attempts'] - 1), error, job['job_id']))
+    get_db().commit()
+    cursor.close()
+
+def run_create_photo_derivatives_job(payload: dict) -> None:
+    create_photo_derivatives(payload['filename'])
+
+    # Cached cards still point to the original image
+    cursor = get_db().cursor()
+    cursor.execute('update photos set version = version + 1 where filename = %s', (payload['filename'], ))
+    get_db().commit()
+    cursor.close()
+
+def run_remove_photo_files_job(payload: dict) -> None:
+    cursor = get_db().cursor()
+
+    for filename in payload['filenames']:
+        # Skip files that were uploaded again since the job was created
+        lock_photo_file(cursor, filename)
+        cursor.execute('select 1 from photo_files where filename = %s', (filename, ))
+        if cursor.fetchone() is None:
+            remove_photo_files(filename)
+        get_db().commit()
+
+    cursor.close()
+
+def run_compute_photo_recommendations_job(payload: dict) -> None:
+    # Replace the stored recommendations in one transaction, so readers see either the old or the new ones.
+    # The candidates go away with the state (on delete cascade).
+    cursor = get_db().cursor()
+    cursor.execute('delete from photo_recommendation_states where user_id = %s', (payload['user_id'], ))
+    cursor.close()
+    compute_photo_recommendations(payload['user_id'])
 
-@app.context_processor
-def inject_functions():
-    # Credits: https://flask.palletsprojects.com/en/3.0.x/templating/#context-processors
-    return dict(get_photo_url=get_photo_url)
+job_handlers = {
+    'create_photo_derivatives': run_create_photo_derivatives_job,
+    'remove_photo_files': run_remove_photo_files_job,
+    'compute_photo_recommendations': run_compute_photo_recommendations_job,
+}
+
+def run_next_job() -> bool:
+    job = claim_job()
+    if job is None:
+        return False
+
+    try:
+        job_handlers[job['kind']](job['payload'])
+    except Exception:
+        get_db().rollback()
+        fail_job(job, traceback.format_exc())
+        click.echo(f'Error: Job {job["job_id"]} ({job["kind"]}) failed on attempt {job["attempts"]}', err=True)
+        return True
+
+    complete_job(job['job_id'])
+    return True
+
+# Functions used by the templates. Registered as globals rather than with a context processor,
+# so the photo card macros rendered from Python (see get_photo_cards) can use them too
+app.add_template_global(get_photo_url)
+app.add_template_global(get_page_url)
+
+# Totals per endpoint for /metrics
+request_metrics = collections.defaultdict(lambda: {'requests': 0, 'seconds': 0.0, 'db_queries': 0, 'db_seconds': 0.0, 'query_alarms': 0, 'repeated_query_alarms': 0})
+request_metrics_lock = threading.Lock()
+
+# One JSON line per request, when LOG_REQUESTS is on
+request_logger = logging.getLogger('myfoto.requests')
+if log_requests:
+    request_logger.setLevel(logging.INFO)
+    request_logger.addHandler(logging.StreamHandler())
+
+@app.before_request
+def start_query_stats():
+    # Registered first, so the queries of the other before_request functions are counted too
+    g.query_stats = QueryStats()
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'none'
+    repeated_statements = stats.get_repeated_statements()
+    is_query_alarm = stats.count > max_queries_per_request
+    is_repeated_query_alarm = len(repeated_statements) > 0
+
+    response.headers['X-DB-Queries'] = str(stats.count)
+    response.headers['X-DB-Time'] = f'{stats.seconds * 1000:.1f}ms'
+
+    with request_metrics_lock:
+        metrics = request_metrics[endpoint]
+        metrics['requests'] += 1
+        metrics['seconds'] += seconds
+        metrics['db_queries'] += stats.count
+        metrics['db_seconds'] += stats.seconds
+        metrics['query_alarms'] += int(is_query_alarm)
+        metrics['repeated_query_alarms'] += int(is_repeated_query_alarm)
+
+    # Most requests are neither logged nor alarming, so the entry is only built when it is needed
+    if not log_requests and not is_query_alarm and not is_repeated_query_alarm:
+        return response
+
+    entry = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': response.status_code,
+        'ms': round(seconds * 1000, 1),
+        'db_queries': stats.count,
+        'db_ms': round(stats.seconds * 1000, 1),
+        'slowest': list(map(lambda item: {'ms': round(item[0] * 1000, 1), 'statement': item[1]}, stats.slowest)),
+        'repeated': repeated_statements,
+    }
+    if log_requests:
+        request_logger.info(json.dumps(entry))
+
+    # Too many queries, or the same one run in a loop, usually means a missing batch lookup
+    if is_query_alarm:
+        app.logger.warning(json.dumps({'alarm': 'max_queries', 'limit': max_queries_per_request, **entry}))
+    elif is_repeated_query_alarm:
+        app.logger.warning(json.dumps({'alarm': 'repeated_queries', 'threshold': repeated_query_threshold, **entry}))
+
+    return response
+
+# Endpoints that never touch the session, so their responses carry no Set-Cookie or Vary: Cookie header.
+# Photos are cached publicly (see serve_photo), and health checks and metrics scrapes are not users.
+sessionless_endpoints = {'serve_photo', 'static', 'healthz', 'readyz', 'prometheus_metrics', 'pool_metrics', 'cache_metrics'}
 
 @app.before_request
 def store_prev_url():
+    if request.endpoint in sessionless_endpoints:
+        return
     session['prev_url'] = request.path
 
 @app.before_request
 def load_logged_in_user():
+    if request.endpoint in sessionless_endpoints:
+        g.user = None
+        return
     # Credits: https://flask.palletsprojects.com/en/3.0.x/tutorial/views/
     # Get the user id from the session
     user_id = str(session.get('user_id'))
@@ -675,15 +2117,15 @@ def logout():
 
 @app.get('/albums')
 def list_albums():
-    albums = get_all_albums()
-    return render_template('list_albums.jinja', albums=albums, owner=None)
+    albums, prev_cursor, next_cursor = get_all_albums(*get_page_cursors())
+    return render_template('list_albums.jinja', albums=albums, owner=None, prev_cursor=prev_cursor, next_cursor=next_cursor)
 
 @app.route('/users/<int:owner_id>/albums', methods=['GET', 'POST'])
 def user_albums(owner_id: int):
     def render():
-        albums = get_albums_by_owner_id(owner_id)
+        albums, prev_cursor, next_cursor = get_albums_by_owner_id(owner_id, *get_page_cursors())
         owner = get_user_by_user_id(owner_id)
-        return render_template('list_albums.jinja', albums=albums, owner=owner)
+        return render_template('list_albums.jinja', albums=albums, owner=owner, prev_cursor=prev_cursor, next_cursor=next_cursor)
 
     if request.method == 'GET' or g.user is None or g.user['user_id'] != owner_id:
         # The user is trying to get a list of albums
@@ -706,10 +2148,10 @@ def user_albums(owner_id: int):
 @app.route('/albums/show/<int:album_id>', methods=['GET', 'POST'])
 def show_album(album_id: int):
     def render():
-        photos_dictrows = get_photos_by_album_id(album_id)
-        photos = get_photo_info(photos_dictrows, set_album_owner_id=False, set_like_info=True, set_comments=True, set_tags=True)
+        photos_dictrows, prev_cursor, next_cursor = get_photos_by_album_id(album_id, *get_page_cursors())
+        photos = get_photo_cards(photos_dictrows, owner_id=owner['user_id'])
         is_friend = False if g.user is None else get_friend_status(g.user['user_id'], owner['user_id'])
-        return render_template('show_album.jinja', album=album, photos=photos, owner=owner, is_friend=is_friend)
+        return render_template('show_album.jinja', album=album, photos=photos, owner=owner, is_friend=is_friend, prev_cursor=prev_cursor, next_cursor=next_cursor)
 
     album = get_album_by_album_id(album_id)
     owner = get_user_by_user_id(album['owner_id'])
@@ -720,6 +2162,10 @@ def show_album(album_id: int):
 
     # This is a POST
 
+    if ('add-friend' in request.form or 'remove-friend' in request.form) and g.user is None:
+        flash('You must be logged in to add friends')
+        return render()
+
     if 'add-friend' in request.form:
         add_friend(g.user['user_id'], owner['user_id'])
         return render()
@@ -745,10 +2191,14 @@ def is_post_request_like_or_comment():
     
     photo_id = int(photo_id)
     
-    if 'like-photo' in request.form:
-        like_photo(g.user['user_id'], photo_id)
+    if ('like-photo' in request.form or 'unlike-photo' in request.form) and g.user is None:
+        flash('You must be logged in to like photos')
+    elif 'like-photo' in request.form:
+        if like_photo(g.user['user_id'], photo_id) is None:
+            flash('Photo does not exist')
     elif 'unlike-photo' in request.form:
-        unlike_photo(g.user['user_id'], photo_id)
+        if unlike_photo(g.user['user_id'], photo_id) is None:
+            flash('Photo does not exist')
     elif 'add-comment' in request.form:
         comment_text = request.form.get('comment', '')
         if len(comment_text) < 3:
@@ -760,13 +2210,25 @@ def is_post_request_like_or_comment():
 
     return True
 
+@app.errorhandler(UploadRejected)
+def upload_rejected(error):
+    # The form parser stopped reading the upload, send the user back to the form
+    flash(error.description)
+    return redirect(request.url)
+
+@app.errorhandler(413)
+def request_too_large(error):
+    # The body was refused because of MAX_CONTENT_LENGTH, send the user back to the form
+    flash(f'Upload is too large, the limit is {app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)} MB')
+    return redirect(request.url)
+
 @app.route('/albums/edit/<int:album_id>', methods=['GET', 'POST'])
 def edit_album(album_id: int):
     def render():
         # Get photos from existing albums
-        photo_dictrows = get_photos_by_album_id(album_id)
+        photo_dictrows, prev_cursor, next_cursor = get_photos_by_album_id(album_id, *get_page_cursors())
         photos = get_photo_info(photo_dictrows, set_album_owner_id=False, set_like_info=False, set_comments=False, set_tags=True)
-        return render_template('edit_album.jinja', album=album, photos=photos)
+        return render_template('edit_album.jinja', album=album, photos=photos, prev_cursor=prev_cursor, next_cursor=next_cursor)
     
     album = get_album_by_album_id(album_id)
     
@@ -808,12 +2270,8 @@ def edit_album(album_id: int):
     return render()
 
 def upload_photo(album_id: int):
-    # Get file and caption
-    if 'photo-file' not in request.files:
-        flash('Photo file was not attached')
-        return
-    
-    file = request.files.get('photo-file', None)
+    # Get files and caption. Several files can be uploaded at once, they get the same caption and tags.
+    files = list(filter(lambda file: file.filename != '', request.files.getlist('photo-file')))
     caption = request.form.get('caption', '')
     
     # Validate tags string
@@ -824,65 +2282,60 @@ def upload_photo(album_id: int):
         return
     
     # Handle errors
-    if file.filename == '':
+    if len(files) == 0:
         flash('No selected file')
         return
-    if not file or not is_filename_image(file.filename):
-        flash('Inappropriate file format')
-        return
     
-    # Concatenate extension to file
-    filename = f'{uuid.uuid4().hex}.{get_extension(file.filename)}'
-
-    # Save the file
-    file.save(get_photo_filename_path(filename))
+    # The form parser already wrote, hashed and checked the files (see PhotoUpload).
+    # Name the files by their content, so the same image is only stored once.
+    photos = []
+    temp_paths = []
+    for file in files:
+        upload = file.stream
+        upload.close()
+        # The file ended before its header told its dimensions
+        if upload.image_info is None:
+            flash(f'{file.filename}: Inappropriate file format')
+            continue
+
+        # Without a caption, use the name of the file
+        photos.append((caption or file.filename.rsplit('.', 1)[0], get_content_addressed_filename(upload.content_hash.hexdigest(), upload.image_info[0])))
+        temp_paths.append(upload.temp_path)
+
+    if len(photos) == 0:
+        return
 
-    # Insert photo into database
-    photo_id = add_photo(caption, filename, album_id)
-    if photo_id is None:
+    # Insert photos and tags into the database, the renditions are added by the worker.
+    # The files are moved in place after the references to them are committed, see lock_photo_file.
+    # If the insert fails, the temporary files are deleted by remove_photo_uploads.
+    photo_ids = add_photos(album_id, photos, tag_labels)
+    if photo_ids is None:
         return
-    
-    # Create tags
-    for tag_label in tag_labels:
-        # If tag does not exist
-        if not does_tag_exist(tag_label):
-            # Create the tag
-            if not add_tag(tag_label):
-                return
-            
-    # Add tags to photo
-    for tag_label in tag_labels:
-        if not add_photo_tag(photo_id, tag_label):
-            return
-     
-    flash('Photo uploaded successfully')
 
-def delete_photo(photo_id: int):
-    # Delete the file
-    photo_filename = get_photo_filename_by_photo_id(photo_id)
-    
-    full_filename = get_photo_filename_path(photo_filename)
-    try:
-        os.remove(full_filename)
-    except Exception:
-        print(f'Error: Could not remove photo file: {full_filename}')
+    list(map(lambda temp_path, photo: place_photo_file(temp_path, photo[1]), temp_paths, photos))
+    flash('Photo uploaded successfully' if len(photo_ids) == 1 else f'{len(photo_ids)} photos uploaded successfully')
 
-    # Delete from the database
-    cursor = connection.cursor()
+def delete_photo(photo_id: int):
+    # Delete from the database, the worker removes the files once this is committed
+    cursor = get_db().cursor()
     error = None
 
     try:
+        subtract_deleted_photos_from_scores(cursor, 'p.photo_id = %s', (photo_id, ))
+        invalidate_photo_recommendations(cursor, 'p.photo_id = %s', (photo_id, ))
+        release_photo_files(cursor, 'p.photo_id = %s', (photo_id, ))
         cursor.execute('delete from photos where photo_id = %s', (photo_id,))
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
+    get_db().commit()
     cursor.close()
 
     if error is not None:
         flash(error)
         return 
     
+    invalidate('famous_tags', famous_tag_count)
     flash('Photo deleted successfully')
 
 @app.route('/albums/delete/<int:album_id>', methods=['GET', 'POST'])
@@ -900,40 +2353,34 @@ def delete_album(album_id: int):
         flash('Not allowed')
         return redirect(url_for('home'))
 
-    # Delete the photo files for this album
-    photos = get_photos_by_album_id(album_id)
-    
-    for photo in photos:
-        full_filename = get_photo_filename_path(photo['filename'])
-        try:
-            os.remove(full_filename)
-        except Exception:
-            print(f'Error: Could not remove photo file: {full_filename}')
-
-    # Delete the album
-    cursor = connection.cursor()
+    # Delete the album, the worker removes the photo files once this is committed
+    cursor = get_db().cursor()
     error = None
     
     try:
+        subtract_deleted_photos_from_scores(cursor, 'p.album_id = %s', (album_id, ))
+        invalidate_photo_recommendations(cursor, 'p.album_id = %s', (album_id, ))
+        release_photo_files(cursor, 'p.album_id = %s', (album_id, ))
         cursor.execute('delete from albums where album_id = %s', (album_id, ))
     except Exception as e:
         error = f'An error occurred. Please try again later. Error: {e}'
 
-    connection.commit()
+    get_db().commit()
     cursor.close()
 
     if error is not None:
         flash(error)
         return redirect(url_for('user_albums', owner_id=g.user['user_id']))
 
+    invalidate('album', album_id)
+    invalidate('famous_tags', famous_tag_count)
     flash('Album successfully deleted')
     return redirect(url_for('user_albums', owner_id=g.user['user_id']))
 
 @app.route('/photos/search', methods=['GET', 'POST'])
 def search_photos():
     def render():
-        print(photos)
-        return render_template('search_photos.jinja', photos=photos, is_search=is_search, is_my_photos=is_my_photos, famous_tags=famous_tags)
+        return render_template('search_photos.jinja', photos=photos, is_search=is_search, is_my_photos=is_my_photos, famous_tags=famous_tags, prev_cursor=prev_cursor, next_cursor=next_cursor)
         
     if request.method == 'POST':
         # Try to process the POST request as a like or comment
@@ -942,12 +2389,14 @@ def search_photos():
             flash('Invalid method')
 
     # Show the page
-    famous_tags = get_famous_tags(10)
+    famous_tags = get_famous_tags(famous_tag_count)
     tags_string = request.args.get('tags', '')
     user_id = request.args.get('user_id', '')
     user_id = int(user_id) if user_id.isdigit() else None
     is_my_photos = user_id is not None and g.user is not None and g.user['user_id'] == user_id
     photos = []
+    prev_cursor = None
+    next_cursor = None
     is_search = False
     
     if len(tags_string) == 0:
@@ -955,15 +2404,15 @@ def search_photos():
         return render()
     
     # Search photos by tags
-    tag_labels = parse_tags_string(tags_string)
-    if tag_labels is None:
+    tag_clauses = parse_tag_query(tags_string)
+    if tag_clauses is None:
         flash('Please enter valid tags and no other symbols')
         return render()
 
-    # Get photos depending on if user id was given
+    # Get photos, only of the given user if user id was given
     is_search = True
-    photos_dictrows = get_all_photos_by_tags(tag_labels) if user_id is None else get_user_photos_by_tags(tag_labels, user_id)
-    photos = get_photo_info(photos_dictrows, set_album_owner_id=True, set_like_info=True, set_comments=True, set_tags=True)
+    photos_dictrows, prev_cursor, next_cursor = search_photos_by_tags(tag_clauses, user_id, *get_page_cursors())
+    photos = get_photo_cards(photos_dictrows)
     return render()
 
 @app.route('/photos/recommendations', methods=['GET', 'POST'])
@@ -980,11 +2429,64 @@ def recommend_photos():
 
     # Show the page
     user_id = g.user['user_id']
-    user_top_tags = get_user_top_tags(user_id, 5)
-    photo_dictrows = get_recommended_photos(user_top_tags, user_id)
-    photos = get_photo_info(photo_dictrows, set_album_owner_id=True, set_like_info=True, set_comments=True, set_tags=True)
+    user_top_tags, photo_dictrows, prev_cursor, next_cursor = get_recommended_photos(user_id, *get_page_cursors())
+    photos = get_photo_cards(photo_dictrows)
+
+    return render_template('recommend_photos.jinja', user_top_tags=user_top_tags, photos=photos, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+@app.get('/photos/<int:photo_id>/likes')
+def photo_likes(photo_id: int):
+    photos = get_photos_by_photo_ids([photo_id])
+    if len(photos) == 0:
+        flash('Photo does not exist')
+        return redirect(url_for('home'))
+
+    users, prev_cursor, next_cursor = get_photo_likers(photo_id, *get_page_cursors())
+    return render_template('photo_likes.jinja', photo=photos[0], users=users, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+@app.get('/photos/<int:photo_id>/comments')
+def photo_comments(photo_id: int):
+    photos = get_photos_by_photo_ids([photo_id])
+    if len(photos) == 0:
+        flash('Photo does not exist')
+        return redirect(url_for('home'))
+
+    comments, prev_cursor, next_cursor = get_photo_comments(photo_id, *get_page_cursors())
+    return render_template('photo_comments.jinja', photo=photos[0], comments=comments, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+@app.post('/photos/<int:photo_id>/like')
+def toggle_photo_like(photo_id: int):
+    """
+    Like (liked=true) or unlike (liked=false) a photo without reloading the page, see toggle.js
+    Returns the new state as JSON
+    """
+    if g.user is None:
+        return jsonify({'error': 'You must be logged in to like photos'}), 401
 
-    return render_template('recommend_photos.jinja', user_top_tags=user_top_tags, photos=photos)
+    liked = request.form.get('liked', '') == 'true'
+    like_count = like_photo(g.user['user_id'], photo_id) if liked else unlike_photo(g.user['user_id'], photo_id)
+    if like_count is None:
+        return jsonify({'error': 'Photo does not exist'}), 404
+
+    return jsonify({'photo_id': photo_id, 'liked': liked, 'like_count': like_count})
+
+@app.post('/users/<int:friend_id>/friend')
+def toggle_friend(friend_id: int):
+    """
+    Add (is_friend=true) or remove (is_friend=false) a friend without reloading the page, see toggle.js
+    Returns the new state as JSON
+    """
+    if g.user is None:
+        return jsonify({'error': 'You must be logged in to add friends'}), 401
+
+    if request.form.get('is_friend', '') == 'true':
+        is_friend = add_friend(g.user['user_id'], friend_id)
+        if not is_friend:
+            return jsonify({'error': 'User does not exist'}), 404
+    else:
+        is_friend = remove_friend(g.user['user_id'], friend_id)
+
+    return jsonify({'friend_id': friend_id, 'is_friend': is_friend})
 
 @app.get('/comments/search')
 def search_comments():
@@ -1007,12 +2509,13 @@ def user_friends():
         # Adding or removing a friend
         friend_id = request.form.get('friend-id', '')
 
-        if len(friend_id) == 0:
+        if len(friend_id) == 0 or not friend_id.isdigit():
             flash('Friend id is invalid')
         elif 'add-friend' in request.form:
-            add_friend(g.user['user_id'], friend_id)
+            if not add_friend(g.user['user_id'], int(friend_id)):
+                flash('User does not exist')
         elif 'remove-friend' in request.form:
-            remove_friend(g.user['user_id'], friend_id)
+            remove_friend(g.user['user_id'], int(friend_id))
     
     # Friends
     friends = get_user_friends(g.user['user_id'])
@@ -1021,9 +2524,11 @@ def user_friends():
     search_query = request.args.get('query', '')
     search_results = None
 
-    if len(search_query) > 0:
+    if len(search_query) >= name_search_min_length:
         # Searching for users
         search_results = get_non_friends_by_first_or_last_name_containing(g.user['user_id'], search_query)
+    elif len(search_query) > 0:
+        flash(f'Please enter at least {name_search_min_length} characters to search')
 
     # Recommendations
     recommendations = get_friend_recommendations(g.user['user_id'])
@@ -1031,5 +2536,381 @@ def user_friends():
     # Display everything
     return render_template('friends.jinja', friends=friends, search_results=search_results, recommendations=recommendations)
 
+@app.cli.command('rebuild-scores')
+@click.option('--verify-only', is_flag=True, help='Only report drift, do not fix it.')
+def rebuild_scores_command(verify_only: bool):
+    """Recompute user contribution scores from scratch and report drift."""
+    drift = get_user_score_drift()
+    for row in drift:
+        click.echo(
+            f'User {row["user_id"]}: '
+            f'comments {row["comment_count"]} (expected {row["expected_comment_count"]}), '
+            f'photos {row["photo_count"]} (expected {row["expected_photo_count"]})'
+        )
+    click.echo(f'{len(drift)} user(s) with drifted scores')
+
+    if not verify_only and len(drift) > 0:
+        rebuild_user_scores()
+        click.echo('Scores rebuilt')
+
+@app.cli.command('create-derivatives')
+@click.option('--force', is_flag=True, help='Regenerate renditions that already exist.')
+def create_derivatives_command(force: bool):
+    """Generate the smaller renditions of photos uploaded before they existed."""
+    # Named cursors stream the rows from the server instead of loading them all
+    cursor = get_db().cursor('photo_filenames')
+    cursor.execute('select filename from photos order by photo_id')
+    created = 0
+
+    for (filename, ) in cursor:
+        if not force and all(map(lambda size: os.path.exists(get_photo_filename_path(get_photo_derivative_filename(filename, size))), photo_sizes)):
+            continue
+        try:
+            create_photo_derivatives(filename)
+            created += 1
+        except Exception as e:
+            click.echo(f'Could not process {filename}: {e}')
+
+    cursor.close()
+    click.echo(f'Created renditions for {created} photo(s)')
+
+@app.cli.command('run-worker')
+@click.option('--poll-interval', default=1.0, help='Seconds to wait when there are no jobs.')
+@click.option('--once', is_flag=True, help='Exit once there are no jobs left.')
+def run_worker_command(poll_interval: float, once: bool):
+    """Run background jobs: photo renditions, tagging and file removal."""
+    click.echo('Worker started')
+    while True:
+        # Use a fresh app context per job so the connection goes back to the pool in between
+        with app.app_context():
+            ran_job = run_next_job()
+
+        if not ran_job:
+            if once:
+                break
+            time.sleep(poll_interval)
+
+@app.get('/users/search')
+def search_users():
+    """
+    Typeahead for the friends page
+    Returns up to `limit` users who are not friends yet and whose name contains `query`, as JSON
+    """
+    if g.user is None:
+        return jsonify({'error': 'You must be logged in to search for people'}), 401
+
+    query = request.args.get('query', '').strip()
+    limit = request.args.get('limit', '')
+    limit = min(int(limit), page_size) if limit.isdigit() else 10
+
+    # Too short queries match nearly everyone and can't use the trigram index
+    if len(query) < name_search_min_length:
+        return jsonify([])
+
+    users = get_non_friends_by_first_or_last_name_containing(g.user['user_id'], query, limit)
+    return jsonify(list(map(lambda user: {'user_id': user['user_id'], 'first_name': user['first_name'], 'last_name': user['last_name']}, users)))
+
+@app.cli.command('rebuild-friend-recommendations')
+def rebuild_friend_recommendations_command():
+    """Recompute all friend recommendations from the friends graph."""
+    row_count = rebuild_friend_recommendations()
+    click.echo(f'Stored {row_count} friend-of-friend pair(s)')
+
+@app.cli.command('rebuild-photo-counts')
+def rebuild_photo_counts_command():
+    """Recount the likes and comments of every photo."""
+    click.echo(f'Fixed the counts of {rebuild_photo_counts()} photo(s)')
+
+@app.get('/photos/file/<path:filename>')
+def serve_photo(filename: str):
+    """
+    Serve a photo file (original or rendition)
+    Photo filenames are never reused and the files never change, so they can be cached forever
+    and the filename works as a strong ETag. Handles If-None-Match (304) and Range requests.
+    """
+    if photo_sendfile == 'x-accel-redirect':
+        # Let nginx send the file from an internal location mapped to the photos directory
+        if '..' in filename.split('/'):
+            return 'Not found', 404
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = f'{photo_accel_redirect_prefix}/{filename}'
+        # nginx picks the content type from the file extension
+        del response.headers['Content-Type']
+    else:
+        # Without a front proxy, the WSGI server's file wrapper sends the file (with sendfile where supported)
+        response = send_from_directory(os.path.abspath(os.path.join('static', photos_dir)), filename, etag=filename, conditional=True)
+
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.cli.command('rebuild-photo-files')
+def rebuild_photo_files_command():
+    """Recount how many photos use each stored file."""
+    cursor = get_db().cursor()
+    cursor.execute("""
+        insert into photo_files (filename, ref_count)
+        select p.filename, count(*)
+        from photos p
+        group by p.filename
+        on conflict (filename) do update
+        set ref_count = excluded.ref_count
+    """)
+    click.echo(f'Counted references to {cursor.rowcount} file(s)')
+    get_db().commit()
+    cursor.close()
+
+# JSON API, versioned so the mobile client keeps working when it changes.
+# Lists take the same after/before cursors as the pages, and limit. All responses take fields=a,b to only
+# return some of the fields of each item. Photo responses get their ETag from the photo versions, so a client
+# that sends If-None-Match gets a 304 without the rest of the response being read from the database.
+api_max_limit = 100
+
+def dump_api_json(body) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(body)
+    return json.dumps(body, separators=(',', ':'), default=str).encode()
+
+def get_api_limit() -> int:
+    limit = request.args.get('limit', '')
+    return min(int(limit), api_max_limit) if limit.isdigit() and int(limit) > 0 else page_size
+
+def get_api_etag(*parts) -> str:
+    # The viewer and the query string are part of every ETag, since they change the response
+    user_id = None if g.user is None else g.user['user_id']
+    return hashlib.blake2b(repr((user_id, request.full_path, parts)).encode(), digest_size=16).hexdigest()
+
+def select_api_fields(item: dict) -> dict:
+    fields = request.args.get('fields', '')
+    if len(fields) == 0:
+        return item
+    fields = set(fields.split(','))
+    return dict(filter(lambda field: field[0] in fields, item.items()))
+
+def make_api_response(data, prev_cursor: str | None = None, next_cursor: str | None = None, etag: str | None = None, status: int = 200):
+    body = {'data': list(map(select_api_fields, data)) if isinstance(data, list) else select_api_fields(data)}
+    if prev_cursor is not None or next_cursor is not None:
+        body['prev'] = prev_cursor
+        body['next'] = next_cursor
+
+    response = app.response_class(dump_api_json(body), status=status, mimetype='application/json')
+    if status == 200:
+        response.set_etag(etag or hashlib.blake2b(response.get_data(), digest_size=16).hexdigest(), weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        # Turns the response into a 304 if the client has it already
+        response.make_conditional(request)
+    return response
+
+def make_api_not_modified_response(etag: str):
+    # For when the ETag alone shows the client is up to date, before reading the rest of the response
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def make_api_error(message: str, status: int):
+    return app.response_class(dump_api_json({'error': message}), status=status, mimetype='application/json')
+
+def get_api_photos(photos: list[DictRow]) -> list[dict]:
+    photo_ids = list(map(lambda photo: photo['photo_id'], photos))
+    tag_labels = get_photos_tag_labels(photo_ids) if len(photo_ids) > 0 else {}
+    liked_photo_ids = set() if g.user is None or len(photo_ids) == 0 else get_liked_photo_ids(photo_ids, g.user['user_id'])
+
+    return list(map(lambda photo: {
+        'photo_id': photo['photo_id'],
+        'album_id': photo['album_id'],
+        'caption': photo['caption'],
+        'version': photo['version'],
+        'like_count': photo['like_count'],
+        'comment_count': photo['comment_count'],
+        'tag_labels': tag_labels.get(photo['photo_id'], []),
+        'is_liked': photo['photo_id'] in liked_photo_ids,
+        'url': get_photo_url(photo),
+        'thumb_url': get_photo_url(photo, 'thumb'),
+        'medium_url': get_photo_url(photo, 'medium'),
+    }, photos))
+
+def get_api_album(album: DictRow) -> dict:
+    # Only these fields are public, the owner's name is there when the album was read with it
+    return {
+        'album_id': album['album_id'],
+        'name': album['name'],
+        'creation_date': album['creation_date'],
+        'owner_id': album['owner_id'],
+        **({'owner_first_name': album['owner_first_name'], 'owner_last_name': album['owner_last_name']} if 'owner_first_name' in album.keys() else {}),
+    }
+
+def make_api_photos_response(photos: list[DictRow], prev_cursor: str | None, next_cursor: str | None):
+    # The cursors are part of the body too: a photo added after a full last page gives it a next cursor
+    etag = get_api_etag(list(map(lambda photo: (photo['photo_id'], photo['version']), photos)), prev_cursor, next_cursor)
+    return make_api_not_modified_response(etag) or make_api_response(get_api_photos(photos), prev_cursor, next_cursor, etag)
+
+@app.get('/api/v1/albums')
+def api_albums():
+    albums, prev_cursor, next_cursor = get_all_albums(*get_page_cursors(), get_api_limit())
+    return make_api_response(list(map(get_api_album, albums)), prev_cursor, next_cursor)
+
+@app.get('/api/v1/albums/<int:album_id>')
+def api_album(album_id: int):
+    album = get_album_by_album_id(album_id)
+    if album is None:
+        return make_api_error('Album does not exist', 404)
+    return make_api_response(get_api_album(album))
+
+@app.get('/api/v1/users/<int:owner_id>/albums')
+def api_user_albums(owner_id: int):
+    albums, prev_cursor, next_cursor = get_albums_by_owner_id(owner_id, *get_page_cursors(), get_api_limit())
+    return make_api_response(list(map(get_api_album, albums)), prev_cursor, next_cursor)
+
+@app.get('/api/v1/albums/<int:album_id>/photos')
+def api_album_photos(album_id: int):
+    photos, prev_cursor, next_cursor = get_photos_by_album_id(album_id, *get_page_cursors(), get_api_limit())
+    return make_api_photos_response(photos, prev_cursor, next_cursor)
+
+@app.get('/api/v1/photos')
+def api_search_photos():
+    """Photos with the tags, e.g. /api/v1/photos?tags=beach OR mountain, only of the user if user_id is given"""
+    tag_clauses = parse_tag_query(request.args.get('tags', ''))
+    if tag_clauses is None or len(tag_clauses) == 0:
+        return make_api_error('Please enter valid tags and no other symbols', 400)
+
+    user_id = request.args.get('user_id', '')
+    user_id = int(user_id) if user_id.isdigit() else None
+    photos, prev_cursor, next_cursor = search_photos_by_tags(tag_clauses, user_id, *get_page_cursors(), get_api_limit())
+    return make_api_photos_response(photos, prev_cursor, next_cursor)
+
+@app.get('/api/v1/photos/recommendations')
+def api_recommended_photos():
+    if g.user is None:
+        return make_api_error('You must be logged in to get photo recommendations', 401)
+
+    _, photos, prev_cursor, next_cursor = get_recommended_photos(g.user['user_id'], *get_page_cursors(), get_api_limit())
+    return make_api_photos_response(photos, prev_cursor, next_cursor)
+
+@app.get('/api/v1/photos/<int:photo_id>')
+def api_photo(photo_id: int):
+    photos = get_photos_by_photo_ids([photo_id])
+    if len(photos) == 0:
+        return make_api_error('Photo does not exist', 404)
+
+    etag = get_api_etag(photos[0]['version'])
+    return make_api_not_modified_response(etag) or make_api_response(get_api_photos(photos)[0], etag=etag)
+
+@app.get('/api/v1/photos/<int:photo_id>/likes')
+def api_photo_likes(photo_id: int):
+    # Likes bump the photo version, so the likers only need to be read when it changed
+    photos = get_photos_by_photo_ids([photo_id])
+    if len(photos) == 0:
+        return make_api_error('Photo does not exist', 404)
+
+    etag = get_api_etag(photos[0]['version'])
+    not_modified_response = make_api_not_modified_response(etag)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    users, prev_cursor, next_cursor = get_photo_likers(photo_id, *get_page_cursors(), get_api_limit())
+    return make_api_response(list(map(dict, users)), prev_cursor, next_cursor, etag)
+
+@app.get('/api/v1/photos/<int:photo_id>/comments')
+def api_photo_comments(photo_id: int):
+    # Comments bump the photo version too
+    photos = get_photos_by_photo_ids([photo_id])
+    if len(photos) == 0:
+        return make_api_error('Photo does not exist', 404)
+
+    etag = get_api_etag(photos[0]['version'])
+    not_modified_response = make_api_not_modified_response(etag)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    comments, prev_cursor, next_cursor = get_photo_comments(photo_id, *get_page_cursors(), get_api_limit())
+    return make_api_response(list(map(dict, comments)), prev_cursor, next_cursor, etag)
+
+@app.get('/api/v1/tags/famous')
+def api_famous_tags():
+    return make_api_response(list(map(lambda tag_label: {'label': tag_label}, get_famous_tags(famous_tag_count))))
+
+@app.get('/api/v1/friends')
+def api_user_friends():
+    if g.user is None:
+        return make_api_error('You must be logged in to view friends', 401)
+    return make_api_response(list(map(dict, get_user_friends(g.user['user_id']))))
+
+@app.get('/healthz')
+def healthz():
+    # The process is up and serving requests
+    return jsonify({'status': 'ok'})
+
+@app.get('/readyz')
+def readyz():
+    # The process can serve real traffic: it can get a database connection and run a query
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('select 1')
+        cursor.close()
+    except psycopg2.Error as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    return jsonify({'status': 'ok'})
+
+@app.get('/metrics/pool')
+def pool_metrics():
+    return jsonify(open_db_pool().stats())
+
+@app.get('/metrics/cache')
+def cache_metrics():
+    with cache_stats_lock:
+        return jsonify(dict(cache_stats))
+
+def format_prometheus_metric(name: str, metric_type: str, help: str, samples: list[tuple[dict, float]]) -> list[str]:
+    lines = [f'# HELP myfoto_{name} {help}', f'# TYPE myfoto_{name} {metric_type}']
+    for labels, value in samples:
+        label_string = ','.join(map(lambda item: f'{item[0]}="{item[1]}"', labels.items()))
+        lines.append(f'myfoto_{name}{{{label_string}}} {value}' if len(labels) > 0 else f'myfoto_{name} {value}')
+    return lines
+
+@app.get('/metrics')
+def prometheus_metrics():
+    """Request, SQL, pool and cache metrics in the Prometheus text format."""
+    with request_metrics_lock:
+        endpoints = {endpoint: dict(metrics) for endpoint, metrics in request_metrics.items()}
+    with cache_stats_lock:
+        namespaces = {namespace: dict(stats) for namespace, stats in cache_stats.items()}
+    pool_stats = open_db_pool().stats()
+
+    def per_endpoint(key: str) -> list[tuple[dict, float]]:
+        return list(map(lambda item: ({'endpoint': item[0]}, item[1][key]), endpoints.items()))
+
+    def per_namespace(key: str) -> list[tuple[dict, float]]:
+        return list(map(lambda item: ({'namespace': item[0]}, item[1][key]), namespaces.items()))
+
+    lines = [
+        *format_prometheus_metric('requests_total', 'counter', 'Requests handled.', per_endpoint('requests')),
+        *format_prometheus_metric('request_seconds_total', 'counter', 'Time spent handling requests.', per_endpoint('seconds')),
+        *format_prometheus_metric('db_queries_total', 'counter', 'SQL statements run by requests.', per_endpoint('db_queries')),
+        *format_prometheus_metric('db_seconds_total', 'counter', 'Time spent running SQL statements in requests.', per_endpoint('db_seconds')),
+        *format_prometheus_metric('query_alarms_total', 'counter', 'Requests that ran more than MAX_QUERIES statements.', per_endpoint('query_alarms')),
+        *format_prometheus_metric('repeated_query_alarms_total', 'counter', 'Requests that ran the same statement REPEATED_QUERY_THRESHOLD times or more.', per_endpoint('repeated_query_alarms')),
+        *format_prometheus_metric('db_pool_connections', 'gauge', 'Connections in the pool.', [({'state': 'in_use'}, pool_stats['in_use']), ({'state': 'idle'}, pool_stats['idle'])]),
+        *format_prometheus_metric('db_pool_max_connections', 'gauge', 'Maximum connections in the pool.', [({}, pool_stats['max_size'])]),
+        *format_prometheus_metric('db_pool_checkouts_total', 'counter', 'Connections checked out of the pool.', [({}, pool_stats['checkouts'])]),
+        *format_prometheus_metric('db_pool_timeouts_total', 'counter', 'Checkouts that timed out waiting for a connection.', [({}, pool_stats['timeouts'])]),
+        *format_prometheus_metric('db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection.', [({}, pool_stats['wait_seconds_total'])]),
+        *format_prometheus_metric('cache_hits_total', 'counter', 'Read cache hits.', per_namespace('hits')),
+        *format_prometheus_metric('cache_misses_total', 'counter', 'Read cache misses.', per_namespace('misses')),
+        *format_prometheus_metric('cache_invalidations_total', 'counter', 'Read cache invalidations.', per_namespace('invalidations')),
+    ]
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def create_app(open_pool: bool = False) -> Flask:
+    """
+    Return the app for a WSGI server, see wsgi.py and gunicorn.conf.py.
+    Nothing is connected until first use in each process, or right away with open_pool.
+    """
+    if open_pool:
+        open_db_pool()
+    return app
+
 if __name__ == '__main__':
+    # Development server only, use gunicorn (see gunicorn.conf.py) in production
     app.run(debug=True)
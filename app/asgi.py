@@ -0,0 +1,216 @@
+from quart import Quart, render_template, request, session, g, url_for, flash, redirect
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RoutingException
+import asyncpg
+import asyncio
+import functools
+
+import app as wsgi
+from app import config, cache, get_cache_key, record_cache_lookup, keyset_condition, make_page, parse_cursor
+
+# Async entry point: the read-only pages that run several independent queries are served by Quart on asyncpg,
+# with the queries run concurrently. Everything else (forms, uploads, the API, photo files) goes to the Flask app,
+# which runs in a thread pool. Both share the templates, the session cookie and the read cache.
+# Run with an ASGI server from the app directory, e.g.: hypercorn asgi:application --workers 4
+
+quart_app = Quart(__name__)
+quart_app.secret_key = wsgi.app.secret_key
+
+db_pool: asyncpg.Pool | None = None
+
+@quart_app.before_serving
+async def open_db_pool():
+    global db_pool
+    db_pool = await asyncpg.create_pool(
+        min_size = config.getint('Database Config', 'DB_POOL_MIN', fallback=1),
+        max_size = config.getint('Database Config', 'DB_POOL_MAX', fallback=10),
+        host = config.get('Database Config', 'DB_HOST'),
+        database = config.get('Database Config', 'DB_NAME'),
+        user = config.get('Database Config', 'DB_USER'),
+        password = config.get('Database Config', 'DB_PASS')
+    )
+
+@quart_app.after_serving
+async def close_db_pool():
+    await db_pool.close()
+
+def to_asyncpg_query(query: str) -> str:
+    # The queries are written with psycopg2 placeholders (%s), like in app.py. asyncpg numbers them ($1, $2, ...).
+    parts = query.split('%s')
+    return ''.join(map(lambda item: item[1] if item[0] == 0 else f'${item[0]}{item[1]}', enumerate(parts)))
+
+async def fetch(query: str, *params) -> list[dict]:
+    # Each call gets its own connection from the pool, so calls can run at the same time with asyncio.gather
+    return list(map(dict, await db_pool.fetch(to_asyncpg_query(query), *params)))
+
+async def fetch_one(query: str, *params) -> dict | None:
+    rows = await fetch(query, *params)
+    return rows[0] if len(rows) > 0 else None
+
+def cached(namespace: str, ttl: int):
+    # Same as cached in app.py, with the same keys, so both apps share the entries
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args):
+            key = get_cache_key(namespace, *args)
+            hit, value = cache.get(key)
+            record_cache_lookup(namespace, hit)
+
+            # Missing rows are not cached: nothing invalidates them when they are created (e.g. add_album)
+            if not hit:
+                value = await function(*args)
+                if value is not None:
+                    cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
+
+def get_page_cursors() -> tuple[tuple[int, ...] | None, tuple[int, ...] | None]:
+    return parse_cursor(request.args.get('after', '')), parse_cursor(request.args.get('before', ''))
+
+# Same as in app.py, with Quart's url_for and request
+
+def get_photo_url(photo, size: str | None = None) -> str:
+    return url_for('serve_photo', filename=wsgi.get_photo_rendition_filename(photo, size))
+
+def get_page_url(**cursor) -> str:
+    return url_for(request.endpoint, **request.view_args, **wsgi.get_page_url_args(request.args.to_dict(), cursor))
+
+quart_app.add_template_global(get_photo_url)
+quart_app.add_template_global(get_page_url)
+
+@cached('user', ttl=300)
+async def get_user_by_user_id(user_id: int) -> dict | None:
+    return await fetch_one(wsgi.user_by_user_id_query, user_id)
+
+@cached('album', ttl=300)
+async def get_album_by_album_id(album_id: int) -> dict | None:
+    return await fetch_one(wsgi.album_by_album_id_query, album_id)
+
+@cached('friend_status', ttl=300)
+async def get_friend_status(user1_id: int, user2_id: int) -> bool:
+    row = await fetch_one(wsgi.friend_status_query, user1_id, user2_id)
+    return row['count'] == 1
+
+async def get_top_users(user_count: int) -> list[dict]:
+    return await fetch(wsgi.top_users_query, int(wsgi.guest_user_id), user_count)
+
+async def get_albums(owner_id: int | None, after: tuple | None, before: tuple | None, limit: int = wsgi.page_size) -> tuple[list[dict], str | None, str | None]:
+    # All albums, or only the ones of the owner
+    condition, order, cursor_params, after, before = keyset_condition(['a.album_id'], after, before)
+    owner_condition, owner_params = ('a.owner_id = %s', (owner_id, )) if owner_id is not None else ('true', ())
+    albums = await fetch(wsgi.albums_query.format(owner_condition=owner_condition, condition=condition, order=order), *owner_params, *cursor_params, limit + 1)
+    return make_page(albums, lambda album: (album['album_id'], ), after, before, limit)
+
+async def get_photos_by_album_id(album_id: int, after: tuple | None, before: tuple | None, limit: int = wsgi.page_size) -> tuple[list[dict], str | None, str | None]:
+    condition, order, cursor_params, after, before = keyset_condition(['p.photo_id'], after, before)
+    photos = await fetch(wsgi.album_photos_query.format(condition=condition, order=order), album_id, *cursor_params, limit + 1)
+    return make_page(photos, lambda photo: (photo['photo_id'], ), after, before, limit)
+
+async def get_liked_photo_ids(photo_ids: list[int], user_id: int | None) -> set[int]:
+    if user_id is None:
+        return set()
+    rows = await fetch(wsgi.liked_photo_ids_query, user_id, photo_ids)
+    return set(map(lambda row: row['photo_id'], rows))
+
+async def get_photo_card_parts(photo_ids: list[int]) -> tuple[dict, dict, dict]:
+    # The likers, comments and tags of the photos whose cards are not cached, read at the same time
+    likers, comments, tags = await asyncio.gather(
+        fetch(wsgi.card_likers_query, photo_ids, wsgi.card_liker_count),
+        fetch(wsgi.card_comments_query, photo_ids, wsgi.card_comment_count),
+        fetch(wsgi.photos_tag_labels_query, photo_ids),
+    )
+    return wsgi.group_rows_by_photo_id(likers), wsgi.group_rows_by_photo_id(comments), dict(map(lambda row: (row['photo_id'], row['tag_labels']), tags))
+
+async def get_photo_cards(photos: list[dict], owner_id: int, liked_photo_ids: set[int]) -> list[dict]:
+    # Same as get_photo_cards in app.py, for photos of one owner. The cached card parts are shared with the Flask app.
+    user_id = None if g.user is None else g.user['user_id']
+    missing_photos = []
+
+    for photo in photos:
+        if not wsgi.load_photo_card(photo, owner_id, user_id, liked_photo_ids):
+            missing_photos.append(photo)
+
+    if len(missing_photos) == 0:
+        return photos
+
+    # Render the cards that are not cached
+    liked_users, comments, tag_labels = await get_photo_card_parts(list(map(lambda photo: photo['photo_id'], missing_photos)))
+    # The template environment is async, so the macros are awaited
+    macros = await quart_app.jinja_env.get_template('photo_card.jinja').make_module_async()
+
+    for photo in missing_photos:
+        wsgi.set_photo_card_parts(photo, liked_users, comments, tag_labels)
+        wsgi.store_photo_card(photo, {
+            'head': await macros.card_head(photo, photo['is_owner_view']),
+            'likers': await macros.card_likers(photo),
+            'comments': await macros.card_comments(photo),
+        })
+
+    return photos
+
+@quart_app.before_request
+async def load_logged_in_user():
+    session['prev_url'] = request.path
+    user_id = str(session.get('user_id'))
+    g.user = await get_user_by_user_id(int(user_id)) if user_id.isdigit() else None
+
+@quart_app.get('/')
+@quart_app.get('/home')
+async def home():
+    top_users = await get_top_users(10)
+    return await render_template('home.jinja', top_users=top_users)
+
+@quart_app.get('/albums')
+async def list_albums():
+    albums, prev_cursor, next_cursor = await get_albums(None, *get_page_cursors())
+    return await render_template('list_albums.jinja', albums=albums, owner=None, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+@quart_app.get('/users/<int:owner_id>/albums')
+async def user_albums(owner_id: int):
+    (albums, prev_cursor, next_cursor), owner = await asyncio.gather(get_albums(owner_id, *get_page_cursors()), get_user_by_user_id(owner_id))
+    return await render_template('list_albums.jinja', albums=albums, owner=owner, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+@quart_app.get('/albums/show/<int:album_id>')
+async def show_album(album_id: int):
+    user_id = None if g.user is None else g.user['user_id']
+    album, (photos, prev_cursor, next_cursor) = await asyncio.gather(get_album_by_album_id(album_id), get_photos_by_album_id(album_id, *get_page_cursors()))
+    if album is None:
+        await flash('Album does not exist')
+        return redirect(url_for('home'))
+
+    # These only need the album owner and the photo ids, so they run together
+    photo_ids = list(map(lambda photo: photo['photo_id'], photos))
+    owner, is_friend, liked_photo_ids = await asyncio.gather(
+        get_user_by_user_id(album['owner_id']),
+        get_friend_status(user_id, album['owner_id']) if user_id is not None else asyncio.sleep(0, False),
+        get_liked_photo_ids(photo_ids, user_id),
+    )
+    photos = await get_photo_cards(photos, owner['user_id'], liked_photo_ids)
+    return await render_template('show_album.jinja', album=album, photos=photos, owner=owner, is_friend=is_friend, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+# The other endpoints are only known to Quart for url_for in the templates, requests for them go to the Flask app
+for rule in wsgi.app.url_map.iter_rules():
+    if rule.endpoint not in quart_app.view_functions and rule.endpoint != 'static':
+        quart_app.url_map.add(quart_app.url_rule_class(rule.rule, endpoint=rule.endpoint, methods=rule.methods))
+
+async_endpoints = {'home', 'list_albums', 'user_albums', 'show_album'}
+wsgi_application = WsgiToAsgi(wsgi.app)
+url_adapter = quart_app.url_map.bind('')
+
+def is_async_request(scope: dict) -> bool:
+    if scope['method'] not in ('GET', 'HEAD'):
+        return False
+    try:
+        endpoint, _ = url_adapter.match(scope['path'], method=scope['method'])
+    except (HTTPException, RoutingException):
+        return False
+    return endpoint in async_endpoints
+
+async def application(scope, receive, send):
+    # Lifespan events go to Quart, which opens and closes the asyncpg pool
+    if scope['type'] == 'http' and not is_async_request(scope):
+        await wsgi_application(scope, receive, send)
+    else:
+        await quart_app(scope, receive, send)
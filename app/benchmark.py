@@ -0,0 +1,312 @@
+import argparse
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from app import app, get_db
+
+# Load test for the main pages. Generates a synthetic dataset in the configured database (use a separate one!),
+# requests every page through the Flask test client and reports the latency percentiles and queries per request.
+# Run from the app directory:
+#   python benchmark.py generate --reset
+#   python benchmark.py run --save-baseline baseline.json
+#   python benchmark.py run --baseline baseline.json
+
+first_names = ['Ana', 'Ben', 'Cara', 'Dan', 'Eva', 'Filip', 'Goran', 'Hana', 'Ivan', 'Jana', 'Kire', 'Lea', 'Marko', 'Nina', 'Ognen', 'Petra']
+last_names = ['Smith', 'Jones', 'Petrov', 'Novak', 'Garcia', 'Muller', 'Rossi', 'Kowalski', 'Ivanov', 'Silva', 'Brown', 'Lee']
+towns = ['Skopje', 'Boston', 'Berlin', 'Paris', 'Tokyo', 'Lima']
+words = ['sunset', 'beach', 'great', 'photo', 'love', 'this', 'amazing', 'view', 'friends', 'trip', 'mountain', 'city',
+         'night', 'colors', 'wow', 'nice', 'shot', 'family', 'summer', 'winter', 'dog', 'cat', 'food', 'party']
+
+copy_batch_size = 10000
+
+def get_tag_label(i: int) -> str:
+    # Tags may only contain letters: 0 -> taga, 1 -> tagb, ..., 26 -> tagba
+    letters = ''
+    while True:
+        letters = chr(ord('a') + i % 26) + letters
+        i //= 26
+        if i == 0:
+            return 'tag' + letters
+
+def get_zipf_weights(n: int, exponent: float = 1.0) -> list[float]:
+    return list(map(lambda rank: 1 / (rank ** exponent), range(1, n + 1)))
+
+def copy_rows(cursor, table: str, columns: list[str], rows) -> int:
+    # Stream the rows into the table with COPY, a batch at a time
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        buffer.seek(0)
+        cursor.copy_expert(f'copy {table} ({", ".join(columns)}) from stdin with (format csv)', buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % copy_batch_size == 0:
+            flush()
+    flush()
+    return count
+
+def generate(args) -> None:
+    rng = random.Random(args.seed)
+    cursor = get_db().cursor()
+
+    if args.reset:
+        with open('../schema.sql', encoding='utf-8') as file:
+            cursor.execute(file.read())
+    else:
+        cursor.execute('select exists (select 1 from users)')
+        if cursor.fetchone()[0]:
+            sys.exit('The database already has users, use --reset to recreate the tables (deletes everything!)')
+
+    user_ids = list(range(1, args.users + 1))
+    copy_rows(cursor, 'users', ['user_id', 'first_name', 'last_name', 'hometown', 'gender', 'email', 'birth_date', 'password'], map(lambda user_id: (
+        user_id, rng.choice(first_names), rng.choice(last_names), rng.choice(towns), rng.choice(['female', 'male', 'other']),
+        f'user{user_id}@example.com', f'{rng.randint(1950, 2010)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}', 'benchmark-password'
+    ), user_ids))
+
+    # Friend counts follow a power law: most users have a few friends, some have very many.
+    # Popular users are also more likely to be picked as friends.
+    popularity = list(map(lambda user_id: rng.paretovariate(args.friend_alpha), user_ids))
+    # Passing weights makes every choices call add them up again, so do it once
+    popularity_cum_weights = list(itertools.accumulate(popularity))
+    mean_popularity = sum(popularity) / len(popularity)
+    friend_pairs = set()
+    for user_id, weight in zip(user_ids, popularity):
+        friend_count = min(len(user_ids) - 1, round(weight / mean_popularity * args.mean_friends))
+        for friend_id in rng.choices(user_ids, cum_weights=popularity_cum_weights, k=friend_count):
+            if friend_id != user_id:
+                friend_pairs.add((user_id, friend_id))
+    copy_rows(cursor, 'friends', ['user1_id', 'user2_id'], sorted(friend_pairs))
+
+    album_owner_ids = [user_id for user_id in user_ids for _ in range(args.albums_per_user)]
+    copy_rows(cursor, 'albums', ['album_id', 'name', 'creation_date', 'owner_id'], map(lambda album: (
+        album[0], f'Album {album[0]}', '2024-01-01', album[1]
+    ), enumerate(album_owner_ids, start=1)))
+
+    album_ids = range(1, len(album_owner_ids) + 1)
+    photo_album_ids = [album_id for album_id in album_ids for _ in range(rng.randint(0, 2 * args.photos_per_album))]
+    photo_ids = list(range(1, len(photo_album_ids) + 1))
+    copy_rows(cursor, 'photos', ['photo_id', 'caption', 'filename', 'album_id'], map(lambda photo: (
+        photo[0], ' '.join(rng.choices(words, k=3)), f'benchmark/{photo[0]}.jpg', photo[1]
+    ), enumerate(photo_album_ids, start=1)))
+
+    # Tag and word use follow Zipf's law
+    tag_labels = list(map(get_tag_label, range(args.tags)))
+    tag_cum_weights = list(itertools.accumulate(get_zipf_weights(args.tags)))
+    word_cum_weights = list(itertools.accumulate(get_zipf_weights(len(words))))
+    copy_rows(cursor, 'tags', ['label'], map(lambda label: (label, ), tag_labels))
+    copy_rows(cursor, 'photo_tags', ['photo_id', 'tag_label'], (
+        (photo_id, tag_label)
+        for photo_id in photo_ids
+        for tag_label in set(rng.choices(tag_labels, cum_weights=tag_cum_weights, k=rng.randint(0, 2 * args.tags_per_photo)))
+    ))
+    copy_rows(cursor, 'likes', ['user_id', 'photo_id'], (
+        (user_id, photo_id)
+        for photo_id in photo_ids
+        for user_id in set(rng.choices(user_ids, cum_weights=popularity_cum_weights, k=rng.randint(0, 2 * args.likes_per_photo)))
+    ))
+    copy_rows(cursor, 'comments', ['text', 'creation_date', 'photo_id', 'user_id'], (
+        (' '.join(rng.choices(words, cum_weights=word_cum_weights, k=rng.randint(3, 15))), '2024-01-01', photo_id, user_id)
+        for photo_id in photo_ids
+        for user_id in rng.choices(user_ids, cum_weights=popularity_cum_weights, k=rng.randint(0, 2 * args.comments_per_photo))
+    ))
+
+    for table, column in [('users', 'user_id'), ('albums', 'album_id'), ('photos', 'photo_id')]:
+        cursor.execute(f"select setval(pg_get_serial_sequence('{table}', '{column}'), coalesce(max({column}), 0) + 1, false) from {table}")
+    get_db().commit()
+    cursor.close()
+    print(f'Generated {len(user_ids)} users, {len(friend_pairs)} friendships, {len(album_owner_ids)} albums and {len(photo_ids)} photos')
+
+    # Fill the tables the app keeps up to date
+    runner = app.test_cli_runner()
+    for command in ['rebuild-scores', 'rebuild-photo-files', 'rebuild-photo-counts', 'rebuild-friend-recommendations']:
+        print(runner.invoke(args=[command]).output, end='')
+
+def get_sample(query: str, count: int) -> list:
+    cursor = get_db().cursor()
+    cursor.execute(query, (count, ))
+    rows = list(map(lambda tuple: tuple[0], cursor.fetchall()))
+    cursor.close()
+    return rows
+
+def get_endpoints(rng: random.Random, count: int) -> dict[str, list[tuple[int | None, str]]]:
+    # (logged in user id, url) pairs for every page, for random albums, tags, users...
+    with app.app_context():
+        user_ids = get_sample('select user_id from users order by random() limit %s', count)
+        album_ids = get_sample('select album_id from albums order by random() limit %s', count)
+        tag_labels = get_sample('select tag_label from photo_tags group by tag_label order by count(*) desc limit %s', count)
+
+    return {
+        'home': [(None, '/home')] * count,
+        'list_albums': [(None, '/albums')] * count,
+        'show_album': list(map(lambda album_id: (rng.choice(user_ids), f'/albums/show/{album_id}'), album_ids)),
+        'search_photos': list(map(lambda tag_label: (None, f'/photos/search?tags={tag_label}'), rng.choices(tag_labels, k=count))),
+        'recommend_photos': list(map(lambda user_id: (user_id, '/photos/recommendations'), user_ids)),
+        'search_comments': list(map(lambda word: (None, f'/comments/search?query={word}'), rng.choices(words, k=count))),
+        'user_friends': list(map(lambda user_id: (user_id, '/users/friends'), user_ids)),
+        'search_friends': list(map(lambda user_id: (user_id, f'/users/friends?query={rng.choice(first_names)}'), user_ids)),
+    }
+
+def get_percentile(values: list[float], percentile: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percentile - 1]
+
+def make_test_client_sender():
+    client = app.test_client()
+
+    def send(user_id: int | None, url: str) -> tuple[int, dict]:
+        with client.session_transaction() as session:
+            session.clear()
+            if user_id is not None:
+                session['user_id'] = user_id
+        response = client.get(url)
+        return response.status_code, response.headers
+
+    return send
+
+def make_http_sender(base_url: str):
+    # For a running server (e.g. the WSGI or ASGI entry point), logged in with a session cookie signed like the app does
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    def send(user_id: int | None, url: str) -> tuple[int, dict]:
+        request = urllib.request.Request(base_url.rstrip('/') + url)
+        if user_id is not None:
+            request.add_header('Cookie', f'session={serializer.dumps({"user_id": user_id})}')
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers
+
+    return send
+
+def run(args) -> None:
+    rng = random.Random(args.seed)
+    endpoints = get_endpoints(rng, args.requests)
+    send = make_test_client_sender() if args.base_url is None else make_http_sender(args.base_url)
+    results = {}
+
+    def measure(request: tuple[int | None, str]) -> tuple[float, int, int | None]:
+        start = time.perf_counter()
+        status, headers = send(*request)
+        elapsed = time.perf_counter() - start
+        # Counted by the app itself, see report_query_stats. The async pages don't report it.
+        query_count = headers.get('X-DB-Queries')
+        return elapsed * 1000, status, None if query_count is None else int(query_count)
+
+    # The test client is used from one thread, a server gets concurrent requests
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1 if args.base_url is None else args.concurrency) as executor:
+        for name, requests in endpoints.items():
+            if len(requests) == 0:
+                continue
+
+            # The warmup requests fill the caches and are not measured
+            list(executor.map(measure, requests[:args.warmup]))
+            start = time.perf_counter()
+            measurements = list(executor.map(measure, requests))
+            elapsed = time.perf_counter() - start
+
+            latencies = list(map(lambda measurement: measurement[0], measurements))
+            query_counts = list(filter(lambda query_count: query_count is not None, map(lambda measurement: measurement[2], measurements)))
+            results[name] = {
+                'requests': len(measurements),
+                'errors': len(list(filter(lambda measurement: measurement[1] != 200, measurements))),
+                'requests_per_second': round(len(measurements) / elapsed, 1),
+                'p50_ms': round(get_percentile(latencies, 50), 2),
+                'p95_ms': round(get_percentile(latencies, 95), 2),
+                'p99_ms': round(get_percentile(latencies, 99), 2),
+                'queries_per_request': round(statistics.mean(query_counts), 2) if len(query_counts) > 0 else None,
+                'max_queries': max(query_counts) if len(query_counts) > 0 else None,
+            }
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    regressions = print_results(results, baseline, args.tolerance)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f'Saved baseline to {args.save_baseline}')
+
+    if regressions > 0:
+        sys.exit(f'{regressions} regression(s) against the baseline')
+
+def print_results(results: dict, baseline: dict | None, tolerance: float) -> int:
+    # Returns the number of regressions: p95 slower than the baseline by more than the tolerance, or more queries
+    regressions = 0
+    print(f'{"endpoint":<18} {"req/s":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"errors":>7}')
+
+    for name, result in results.items():
+        queries = '-' if result['queries_per_request'] is None else result['queries_per_request']
+        line = f'{name:<18} {result["requests_per_second"]:>8} {result["p50_ms"]:>9} {result["p95_ms"]:>9} {result["p99_ms"]:>9} {queries:>8} {result["errors"]:>7}'
+
+        if baseline is not None and name in baseline:
+            expected = baseline[name]
+            p95_change = (result['p95_ms'] - expected['p95_ms']) / max(expected['p95_ms'], 0.01)
+            # Query counts are only compared when both runs have them
+            is_more_queries = None not in (result['queries_per_request'], expected['queries_per_request']) and result['queries_per_request'] > expected['queries_per_request']
+            line += f'  p95 {p95_change:+.0%}'
+            if expected.get('requests_per_second') is not None:
+                line += f', req/s {(result["requests_per_second"] - expected["requests_per_second"]) / max(expected["requests_per_second"], 0.01):+.0%}'
+            if p95_change > tolerance or is_more_queries:
+                regressions += 1
+                line += '  REGRESSION'
+
+        print(line)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset and benchmark the pages of the app.')
+    parser.add_argument('--seed', type=int, default=1)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='Fill the database with synthetic data')
+    generate_parser.add_argument('--reset', action='store_true', help='Recreate the tables from schema.sql first (deletes everything!)')
+    generate_parser.add_argument('--users', type=int, default=10000)
+    generate_parser.add_argument('--mean-friends', type=int, default=20)
+    generate_parser.add_argument('--friend-alpha', type=float, default=2.0, help='Power law exponent of the friend counts, smaller is more skewed')
+    generate_parser.add_argument('--albums-per-user', type=int, default=2)
+    generate_parser.add_argument('--photos-per-album', type=int, default=10, help='Average, the actual count is between 0 and twice this')
+    generate_parser.add_argument('--tags', type=int, default=500)
+    generate_parser.add_argument('--tags-per-photo', type=int, default=3, help='Average')
+    generate_parser.add_argument('--likes-per-photo', type=int, default=5, help='Average')
+    generate_parser.add_argument('--comments-per-photo', type=int, default=2, help='Average')
+
+    run_parser = commands.add_parser('run', help='Request every page and report latency and query counts')
+    run_parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+    run_parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per endpoint before measuring')
+    run_parser.add_argument('--baseline', help='Compare against results saved with --save-baseline')
+    run_parser.add_argument('--save-baseline', help='Save the results to this file')
+    run_parser.add_argument('--base-url', help='Send the requests to a running server (e.g. http://localhost:8000) instead of the Flask test client')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests with --base-url')
+    run_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p95 slowdown against the baseline (0.2 = 20%%)')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        with app.app_context():
+            generate(args)
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
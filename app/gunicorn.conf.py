@@ -0,0 +1,38 @@
+import configparser
+import multiprocessing
+
+# Gunicorn settings for production: gunicorn -c gunicorn.conf.py (run from the app directory)
+# Reload the workers gracefully with: kill -HUP <master pid>
+
+# Read config from file, like the app
+config = configparser.RawConfigParser()
+config.read('config.txt')
+
+wsgi_app = 'wsgi:application'
+bind = config.get('Server Config', 'BIND', fallback='127.0.0.1:8000')
+
+# Each worker is a process with a few threads. Every thread may hold a database connection,
+# so DB_POOL_MAX should be at least THREADS.
+workers = config.getint('Server Config', 'WORKERS', fallback=multiprocessing.cpu_count() * 2 + 1)
+threads = config.getint('Server Config', 'THREADS', fallback=4)
+worker_class = 'gthread'
+
+# Import the app once in the master and fork the workers from it. The app doesn't connect on import,
+# each worker opens its own connection pool after the fork.
+preload_app = True
+
+# Restart workers after a while so leaks can't build up, not all at the same time
+max_requests = config.getint('Server Config', 'MAX_REQUESTS', fallback=1000)
+max_requests_jitter = max_requests // 10
+
+timeout = config.getint('Server Config', 'TIMEOUT', fallback=30)
+graceful_timeout = config.getint('Server Config', 'GRACEFUL_TIMEOUT', fallback=30)
+
+def post_fork(server, worker):
+    # Connect before the first request, so it doesn't wait for it
+    from app import open_db_pool
+    open_db_pool()
+
+def worker_exit(server, worker):
+    from app import close_db_pool
+    close_db_pool()
@@ -0,0 +1,29 @@
+// Send the like and friend buttons in the background and update them in place, instead of reloading the page.
+// Without JavaScript the forms are posted to the page as usual.
+document.addEventListener('submit', async (event) => {
+    const form = event.target;
+    if (form.dataset.toggleUrl === undefined) {
+        return;
+    }
+    event.preventDefault();
+
+    const button = form.querySelector('[data-active]');
+    const field = form.dataset.toggleField;
+    const body = new URLSearchParams({ [field]: button.dataset.active !== 'true' });
+    const response = await fetch(form.dataset.toggleUrl, { method: 'POST', body });
+    const state = await response.json();
+    if (!response.ok) {
+        alert(state.error);
+        return;
+    }
+
+    button.dataset.active = state[field];
+    button.value = state[field] ? button.dataset.activeLabel : button.dataset.inactiveLabel;
+
+    if (state.like_count !== undefined) {
+        document.querySelectorAll(`[data-like-count="${state.photo_id}"]`).forEach((element) => {
+            element.textContent = state.like_count;
+            element.closest('[data-like-summary]').classList.toggle('d-none', state.like_count === 0);
+        });
+    }
+});
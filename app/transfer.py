@@ -0,0 +1,157 @@
+import argparse
+import concurrent.futures
+import configparser
+import os
+import shutil
+import psycopg2
+
+# Export and import the data of the app to and from a directory, without going through the web forms.
+# Run from the app directory, like the app itself, so config.txt and the photos are found.
+
+# Read config from file
+config = configparser.RawConfigParser()
+config.read('config.txt')
+
+photos_dir = config.get('Photos Config', 'PHOTOS_FOLDER')
+
+# Tables in the order they can be imported (referenced tables first), with the columns to copy.
+# Generated columns and tables the app can rebuild (scores, recommendations, file references, jobs) are left out.
+tables = [
+    ('users', ['user_id', 'first_name', 'last_name', 'hometown', 'gender', 'email', 'birth_date', 'password']),
+    ('friends', ['user1_id', 'user2_id']),
+    ('albums', ['album_id', 'name', 'creation_date', 'owner_id']),
+    ('photos', ['photo_id', 'caption', 'filename', 'album_id', 'version', 'like_count', 'comment_count']),
+    ('tags', ['label']),
+    ('photo_tags', ['photo_id', 'tag_label']),
+    ('likes', ['user_id', 'photo_id']),
+    ('comments', ['comment_id', 'text', 'creation_date', 'photo_id', 'user_id']),
+]
+
+# Serial primary keys, moved past the imported ids so new rows don't collide with them
+sequences = [
+    ('users', 'user_id'),
+    ('albums', 'album_id'),
+    ('photos', 'photo_id'),
+    ('comments', 'comment_id'),
+]
+
+# How many files are copied at once, and how many filenames are read from the database at a time
+file_batch_size = 1000
+
+def connect():
+    return psycopg2.connect(
+        host = config.get('Database Config', 'DB_HOST'),
+        dbname = config.get('Database Config', 'DB_NAME'),
+        user = config.get('Database Config', 'DB_USER'),
+        password = config.get('Database Config', 'DB_PASS')
+    )
+
+def get_photo_filename_path(filename: str) -> str:
+    return f'static/{photos_dir}/{filename}'
+
+def copy_file(source: str, destination: str) -> bool:
+    # Files are named by their content, so an existing file doesn't need to be copied again
+    if os.path.exists(destination):
+        return False
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(source, destination)
+    return True
+
+def copy_files(pairs: list[tuple[str, str]], executor: concurrent.futures.Executor) -> int:
+    # Returns how many files were copied. Missing sources are reported and skipped.
+    def copy_pair(pair: tuple[str, str]) -> bool:
+        try:
+            return copy_file(*pair)
+        except FileNotFoundError:
+            print(f'Missing file: {pair[0]}')
+            return False
+
+    return sum(executor.map(copy_pair, pairs))
+
+def export_data(directory: str, workers: int) -> None:
+    os.makedirs(os.path.join(directory, 'photos'), exist_ok=True)
+    conn = connect()
+    # One snapshot for all the tables, so the export is consistent
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = conn.cursor()
+
+    # COPY streams the rows straight into the file
+    for table, columns in tables:
+        with open(os.path.join(directory, f'{table}.csv'), 'w', encoding='utf-8', newline='') as file:
+            cursor.copy_expert(f'copy (select {", ".join(columns)} from {table} order by 1) to stdout with (format csv, header)', file)
+        print(f'Exported {cursor.rowcount} row(s) from {table}')
+
+    # Only the originals are copied, the renditions can be generated again (flask create-derivatives)
+    named_cursor = conn.cursor('export_photo_files')
+    named_cursor.itersize = file_batch_size
+    named_cursor.execute('select distinct filename from photos')
+    copied = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            filenames = named_cursor.fetchmany(file_batch_size)
+            if len(filenames) == 0:
+                break
+            copied += copy_files(list(map(lambda tuple: (get_photo_filename_path(tuple[0]), os.path.join(directory, 'photos', tuple[0])), filenames)), executor)
+
+    named_cursor.close()
+    print(f'Copied {copied} photo file(s)')
+    conn.rollback()
+    conn.close()
+
+def import_data(directory: str, workers: int) -> None:
+    # Copy the files first, so no imported photo points to a missing file
+    photos_path = os.path.join(directory, 'photos')
+    copied = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for dirpath, _, filenames in os.walk(photos_path):
+            relative_dirpath = os.path.relpath(dirpath, photos_path)
+            pairs = list(map(lambda filename: (os.path.join(dirpath, filename), get_photo_filename_path(os.path.normpath(os.path.join(relative_dirpath, filename)))), filenames))
+            for i in range(0, len(pairs), file_batch_size):
+                copied += copy_files(pairs[i:i + file_batch_size], executor)
+    print(f'Copied {copied} photo file(s)')
+
+    # All the tables in one transaction, so a failed import leaves the database as it was
+    conn = connect()
+    cursor = conn.cursor()
+
+    try:
+        for table, columns in tables:
+            with open(os.path.join(directory, f'{table}.csv'), 'r', encoding='utf-8', newline='') as file:
+                cursor.copy_expert(f'copy {table} ({", ".join(columns)}) from stdin with (format csv, header)', file)
+            print(f'Imported {cursor.rowcount} row(s) into {table}')
+
+        for table, column in sequences:
+            cursor.execute(f"""
+                select setval(pg_get_serial_sequence('{table}', '{column}'), coalesce(max({column}), 0) + 1, false)
+                from {table}
+            """)
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+    conn.commit()
+    conn.close()
+
+    print('Now run these to rebuild the derived data:')
+    print('  flask --app app rebuild-scores')
+    print('  flask --app app rebuild-photo-files')
+    print('  flask --app app rebuild-friend-recommendations')
+    print('  flask --app app create-derivatives')
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import the users, albums, photos and social graph of the app.')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('directory', help='One CSV file per table and a photos directory with the photo files')
+    parser.add_argument('--workers', type=int, default=8, help='How many photo files to copy in parallel')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_data(args.directory, args.workers)
+    else:
+        import_data(args.directory, args.workers)
+
+if __name__ == '__main__':
+    main()
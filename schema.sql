@@ -1,4 +1,14 @@
+create extension if not exists pg_trgm;
+
+drop table if exists jobs;
+drop table if exists photo_files;
+drop table if exists photo_recommendations;
+drop table if exists photo_recommendation_states;
+drop table if exists tag_changes;
+drop table if exists friend_recommendations;
+drop table if exists user_scores;
 drop table if exists comments;
+drop table if exists likes;
 drop table if exists photo_tags;
 drop table if exists tags;
 drop table if exists photos;
@@ -19,6 +29,9 @@ create table users (
     check (length(password) >= 10)
 );
 
+-- Trigram index for searching people by name (the expression must match the one used by the app)
+create index users_full_name_trgm_idx on users using gin (lower(first_name || ' ' || last_name) gin_trgm_ops);
+
 create table friends (
     user1_id serial not null,
     user2_id serial not null,
@@ -41,6 +54,11 @@ create table photos (
     caption varchar (256) not null,
     filename varchar (4096) not null,
     album_id serial not null,
+    -- Bumped whenever the likes, comments, tags or renditions of the photo change
+    version integer not null default 0,
+    -- Kept up to date by the app together with the likes and comments tables
+    like_count integer not null default 0,
+    comment_count integer not null default 0,
     foreign key (album_id) references albums (album_id) on delete cascade
 );
 
@@ -50,6 +68,8 @@ create table comments (
     creation_date date not null,
     photo_id serial,
     user_id serial,
+    -- Kept up to date by Postgres on every insert or update, used for comment search
+    text_search tsvector generated always as (to_tsvector('english', text)) stored,
     foreign key (photo_id) references photos (photo_id) on delete cascade,
     foreign key (user_id) references users (user_id) on delete cascade
 );
@@ -75,3 +95,85 @@ create table likes (
     foreign key (user_id) references users on delete cascade,
     foreign key (photo_id) references photos on delete cascade
 );
+
+-- Contribution score of each user (comments written + photos uploaded), kept up to date by the app
+create table user_scores (
+    user_id integer primary key,
+    comment_count integer not null default 0,
+    photo_count integer not null default 0,
+    score integer generated always as (comment_count + photo_count) stored,
+    foreign key (user_id) references users (user_id) on delete cascade
+);
+
+create index user_scores_score_idx on user_scores (score desc);
+
+-- Background jobs run by the worker (flask run-worker)
+create table jobs (
+    job_id serial primary key,
+    kind varchar(32) not null,
+    payload jsonb not null,
+    status varchar(16) not null default 'pending',
+    attempts integer not null default 0,
+    run_at timestamp not null default now(),
+    last_error text,
+    check (status in ('pending', 'failed'))
+);
+
+create index jobs_pending_run_at_idx on jobs (run_at) where status = 'pending';
+
+-- Photo files are stored by content hash, so several photos can share one file
+create table photo_files (
+    filename varchar (4096) primary key,
+    ref_count integer not null default 0
+);
+
+-- Posting lists for tag search: photos by tag, in photo id order
+create index photo_tags_tag_label_idx on photo_tags (tag_label, photo_id);
+
+create index comments_text_search_idx on comments using gin (text_search);
+
+-- Bounded reads of the likers and latest comments of each photo
+create index likes_photo_id_user_id_idx on likes (photo_id, user_id);
+create index comments_photo_id_comment_id_idx on comments (photo_id, comment_id);
+
+-- Number of the user's friends who have the candidate as a friend, kept up to date by the app
+create table friend_recommendations (
+    user_id integer not null,
+    candidate_id integer not null,
+    mutual_count integer not null,
+    primary key (user_id, candidate_id),
+    foreign key (user_id) references users (user_id) on delete cascade,
+    foreign key (candidate_id) references users (user_id) on delete cascade
+);
+
+create index friend_recommendations_user_id_mutual_count_idx on friend_recommendations (user_id, mutual_count desc);
+
+-- How many times photos with each tag were added or removed. Cached photo recommendations are stale
+-- once the counters of their top tags add up to more than when they were computed.
+create table tag_changes (
+    tag_label varchar (32) primary key,
+    change_count bigint not null
+);
+
+-- Cached photo recommendations: the top tags they were computed from, and the best scoring photos in order
+create table photo_recommendation_states (
+    user_id integer primary key,
+    top_tags varchar (32)[] not null,
+    tag_change_count bigint not null,
+    computed_at timestamp not null,
+    foreign key (user_id) references users (user_id) on delete cascade
+);
+
+create index photo_recommendation_states_top_tags_idx on photo_recommendation_states using gin (top_tags);
+
+create table photo_recommendations (
+    user_id integer not null,
+    rank integer not null,
+    photo_id integer not null,
+    score double precision not null,
+    primary key (user_id, rank),
+    foreign key (user_id) references photo_recommendation_states (user_id) on delete cascade,
+    foreign key (photo_id) references photos (photo_id) on delete cascade
+);
+
+create index photo_recommendations_photo_id_idx on photo_recommendations (photo_id);